@@ -7,6 +7,7 @@ import flask
 
 
 CELERY_TASKS = [
+    'bdc_scripts.radcor',
     'bdc_scripts.radcor.sentinel',
     'bdc_scripts.radcor.landsat'
 ]
@@ -42,6 +43,14 @@ def create_celery_app(flask_app: Flask):
     celery.conf.update(dict(
         CELERY_TASK_ALWAYS_EAGER=always_eager,
         CELERY_RESULT_BACKEND='db+{}'.format(flask_app.config.get('SQLALCHEMY_DATABASE_URI')),
+        # Sweep the catalog replication outbox, in case a publish trigger was lost
+        CELERYBEAT_SCHEDULE={
+            'replicate-catalog': dict(
+                task='bdc_scripts.radcor.tasks.replicate_catalog',
+                schedule=Config.REPLICATION_SWEEP_INTERVAL,
+                options=dict(queue='replication')
+            )
+        },
         # CELERY_TRACK_STARTED=True
     ))
 
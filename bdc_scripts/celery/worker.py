@@ -10,7 +10,7 @@ $ celery -A bdc_scripts.celery.worker:celery -l INFO -Q download
 import logging
 
 # 3rdparty
-from celery.signals import worker_shutdown
+from celery.signals import worker_ready, worker_shutdown
 
 # BDC Scripts
 from bdc_scripts import create_app
@@ -33,3 +33,18 @@ def on_shutdown_release_locks(sender, **kwargs):
 
     logging.info('Turning off Celery...')
     lock_handler.release_all()
+
+
+@worker_ready.connect
+def on_ready_recover_download_slots(sender, **kwargs):
+    """
+    Signal handler of Celery Worker ready
+
+    Releases the SciHub download slots left in use by dead processes of this host
+    (i.e worker killed during a download) and the expired leases of any host.
+    """
+
+    from bdc_scripts.radcor.sentinel.clients import sentinel_clients
+
+    sentinel_clients.recover()
+    sentinel_clients.reap()
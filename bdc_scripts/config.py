@@ -31,6 +31,47 @@ class Config:
     ESPA_URL = os.environ.get('ESPA_URL', 'http://127.0.0.1:5032')
     SEN2COR_URL = os.environ.get('SEN2COR_URL', 'http://127.0.0.1:5031')
     STAC_URL = os.environ.get('STAC_URL', 'http://brazildatacube.dpi.inpe.br/bdc-stac/0.7.0/')
+    # Size of the output blocks used by datastorm merge. Use 0 to warp the whole tile at once
+    MERGE_BLOCK_SIZE = int(os.environ.get('MERGE_BLOCK_SIZE', 512))
+    # Content-addressed cache of datastorm merges
+    MERGE_CACHE_DIR = os.environ.get('MERGE_CACHE_DIR', os.path.join(DATA_DIR, 'Repository/cache/merges'))
+    # Maximum size of merge cache in bytes. Use 0 to disable the cache
+    MERGE_CACHE_MAX_SIZE = int(os.environ.get('MERGE_CACHE_MAX_SIZE', 100 * 1024 ** 3))
+    # Number of threads used by datastorm blend
+    BLEND_THREADS = int(os.environ.get('BLEND_THREADS', os.cpu_count() or 1))
+    # Cloud Optimized GeoTIFF (COG) creation: compression (LZW, DEFLATE, ZSTD), TIFF predictor,
+    # overview resampling of non quality bands and tile size
+    COG_COMPRESS = os.environ.get('COG_COMPRESS', 'LZW')
+    COG_PREDICTOR = int(os.environ.get('COG_PREDICTOR', 1))
+    COG_RESAMPLING = os.environ.get('COG_RESAMPLING', 'AVERAGE')
+    COG_BLOCK_SIZE = int(os.environ.get('COG_BLOCK_SIZE', 256))
+    # Number of bands converted to COG concurrently by publish
+    PUBLISH_THREADS = int(os.environ.get('PUBLISH_THREADS', os.cpu_count() or 1))
+    # Verify the checksum of published files before skipping them on publish. Reads every file again
+    PUBLISH_VERIFY_CHECKSUM = os.environ.get('PUBLISH_VERIFY_CHECKSUM', '0') in ('1', 'true', 'True')
+    # Sentinel downloads: chunk size (bytes) and attempts to resume an interrupted transfer
+    DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 1024 ** 2))
+    DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 5))
+    # Sentinel mirrors (comma separated): "scihub", hub urls, s3://bucket/prefix or archive directories
+    SENTINEL_MIRRORS = os.environ.get('SENTINEL_MIRRORS', 'scihub')
+    # Download each half of Sentinel products from the two fastest mirrors at same time
+    DOWNLOAD_SPLIT = os.environ.get('DOWNLOAD_SPLIT', '0') in ('1', 'true', 'True')
+    # Concurrent downloads allowed by SciHub for each account
+    SENTINEL_SLOTS_PER_ACCOUNT = int(os.environ.get('SENTINEL_SLOTS_PER_ACCOUNT', 2))
+    # Seconds a download slot is kept without heartbeat before being reclaimed
+    SENTINEL_LEASE_TTL = int(os.environ.get('SENTINEL_LEASE_TTL', 120))
+    # S3 uploads: files uploaded at same time, multipart chunk size (bytes) and parts uploaded at same time per file
+    UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', 4))
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 64 * 1024 ** 2))
+    UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 10))
+    # Replication of local catalog into AWS catalog: records per batch and attempts of each record
+    REPLICATION_BATCH_SIZE = int(os.environ.get('REPLICATION_BATCH_SIZE', 500))
+    REPLICATION_MAX_ATTEMPTS = int(os.environ.get('REPLICATION_MAX_ATTEMPTS', 10))
+    # Seconds the replication lock is held and interval (seconds) of the periodic replication sweep
+    REPLICATION_LOCK_TIMEOUT = int(os.environ.get('REPLICATION_LOCK_TIMEOUT', 600))
+    REPLICATION_SWEEP_INTERVAL = int(os.environ.get('REPLICATION_SWEEP_INTERVAL', 300))
+    # Write a tile pyramid of the datacube quick looks for the web viewer
+    QUICK_LOOK_PYRAMID = os.environ.get('QUICK_LOOK_PYRAMID', '0') in ('1', 'true', 'True')
 
 
 class ProductionConfig(Config):
@@ -0,0 +1,333 @@
+"""
+Defines the cloud mask decoders of collections.
+
+A mask decoder translates the quality band of a collection into the cloud mask codes:
+
+    0 - fill
+    1 - clear data
+    2 - cloud
+
+Each decoder is described by a function that receives all the 65536 possible
+quality values (as uint32) and returns their codes. The function runs only once,
+to build a lookup table, so decoding a raster is a single table lookup,
+whatever the collection. Decoders may also define a post processing step over the
+decoded mask (i.e LC8SR dilates the cloud area), along with its halo: the context,
+in pixels around a window, the post processing needs to decode the window as the
+whole scene would be decoded.
+
+New collections can be registered with :func:`mask_decoder`:
+
+    >>> @mask_decoder('CB4_AWFI', 'CB4_MUX')
+    >>> def cbers(values):
+    >>>     return numpy.select([values == 127, values == 255], [1, 2], 0)
+
+The module only requires numpy on import (rasterio, scipy and scikit-image are
+imported when used), so ds_source/soloist.py loads it as ``bdc_mask`` from its
+include directory instead of carrying its own decoders.
+"""
+
+# Python Native
+import logging
+import os
+# 3rdparty
+import numpy
+
+
+MASK_DECODERS = dict()
+
+# Structuring element used to dilate the LC8SR not clear area
+LC8SR_DILATION = numpy.ones((6, 6), dtype=numpy.bool_)
+
+# Clear areas of LC8SR smaller than this (pixels) are filled as not clear
+LC8SR_HOLE_AREA = 80
+
+# A clear area reaching a window through a halo at least this wide has, inside the
+# window, at least LC8SR_HOLE_AREA pixels, so it is never taken as small hole. The
+# dilation radius covers the not clear pixels out of window which are not dilated
+LC8SR_HALO = LC8SR_HOLE_AREA + max(LC8SR_DILATION.shape) // 2
+
+
+class MaskDecoder:
+    """Decode the quality band of a collection through a lookup table."""
+    def __init__(self, name: str, codes, post_process=None, halo=0):
+        self.name = name
+        self._codes = codes
+        self._post_process = post_process
+        self.halo = halo
+        self._lut = None
+
+    @property
+    def lut(self):
+        """The 65536-entry lookup table of quality values. Built on first use."""
+        if self._lut is None:
+            lut = numpy.asarray(self._codes(numpy.arange(65536, dtype=numpy.uint32)), dtype=numpy.uint8)
+            lut.setflags(write=False)
+
+            self._lut = lut
+
+        return self._lut
+
+    def decode(self, raster):
+        """
+        Decode a quality raster (or window) into the cloud mask codes.
+
+        The raster is indexed as uint16, so negative values of signed bands
+        wrap to the end of table (i.e -1 is 65535).
+
+        Returns:
+            numpy.ndarray uint8 cloud mask
+        """
+        rastercm = self.lut[raster.astype(numpy.uint16, copy=False)]
+
+        if self._post_process is not None:
+            rastercm = self._post_process(rastercm)
+
+        return rastercm
+
+
+def mask_decoder(*collections, post_process=None, halo=0):
+    """
+    Register a mask decoder for the given collections.
+
+    Args:
+        collections (str) - Collections decoded
+        post_process (function) - Step over the decoded mask
+        halo (int) - Pixels around a window needed by post_process to decode the window as the whole scene
+    """
+    def _register(codes):
+        decoder = MaskDecoder(codes.__name__, codes, post_process=post_process, halo=halo)
+
+        for collection in collections:
+            MASK_DECODERS[collection] = decoder
+
+        return codes
+
+    return _register
+
+
+def get_mask_decoder(collection: str) -> MaskDecoder:
+    """
+    Retrieve the mask decoder of collection.
+
+    Raises:
+        ValueError when collection has no mask decoder.
+    """
+    if collection not in MASK_DECODERS:
+        raise ValueError('Cloud mask of dataset {} not supported'.format(collection))
+
+    return MASK_DECODERS[collection]
+
+
+def decode_mask(raster, collection: str):
+    """Decode a quality raster into cloud mask codes: 0 fill, 1 clear data and 2 cloud."""
+    return get_mask_decoder(collection).decode(raster)
+
+
+def mask_counts(rastercm):
+    """Count the fill (0), clear (1) and cloud (2) pixels of cloud mask."""
+    return numpy.bincount(rastercm.ravel(), minlength=3)[:3]
+
+
+def batch_mask_counts(masks):
+    """
+    Count the fill, clear and cloud pixels of several cloud masks at once.
+
+    Args:
+        masks (numpy.ndarray) - Stack of cloud masks with shape (masks, rows, cols)
+
+    Returns:
+        numpy.ndarray with shape (masks, 3)
+    """
+    masks = numpy.asarray(masks)
+    total = masks.shape[0]
+
+    # Shift the codes of each mask, so a single bincount pass counts all of them
+    offsets = (numpy.arange(total, dtype=numpy.int64) * 3).reshape((total,) + (1,) * (masks.ndim - 1))
+
+    return numpy.bincount((masks + offsets).ravel(), minlength=3 * total).reshape(total, 3)
+
+
+def mask_statistics(counts):
+    """
+    Evaluate efficacy and cloud ratio from number of fill (0), clear (1) and cloud (2) pixels
+
+    Returns:
+        Tuple with efficacy and cloud ratio
+    """
+    fillpix, clearpix, cloudpix = [int(count) for count in counts]
+
+    totpix = fillpix + clearpix + cloudpix
+    imagearea = clearpix+cloudpix
+    clearratio = 0
+    cloudratio = 100
+    if imagearea != 0:
+        clearratio = round(100.*clearpix/imagearea,1)
+        cloudratio = round(100.*cloudpix/imagearea,1)
+    efficacy = round(100.*clearpix/totpix,2) if totpix else 0
+
+    return efficacy, cloudratio
+
+
+def load_mask(quality_file: str, collection: str, mask_file: str = None):
+    """
+    Read the cloud mask of a quality file, reusing the mask file when it is up to date.
+
+    The decoded mask is written as ``<name>_mask.tif`` (or mask_file) next to
+    quality file, so the next reads skip the decoding. The mask file is reused
+    while it is newer than quality file and it was decoded by the same decoder.
+
+    Args:
+        quality_file (str) - Path to the quality band
+        collection (str) - Collection of quality band
+        mask_file (str) - Path to the cached mask. Default is quality file with suffix "_mask.tif"
+
+    Returns:
+        numpy.ndarray uint8 cloud mask
+    """
+    import rasterio
+
+    decoder = get_mask_decoder(collection)
+
+    if mask_file is None:
+        mask_file = '{}_mask.tif'.format(os.path.splitext(quality_file)[0].replace('_quality', ''))
+
+    if os.path.exists(mask_file) and os.path.getmtime(mask_file) >= os.path.getmtime(quality_file):
+        try:
+            with rasterio.open(mask_file) as dataset:
+                if dataset.tags().get('mask_decoder') == decoder.name:
+                    return dataset.read(1)
+        except rasterio.RasterioIOError as e:
+            logging.warning('Corrupt mask {} - {}'.format(mask_file, e))
+
+    with rasterio.open(quality_file) as dataset:
+        rastercm = decoder.decode(dataset.read(1))
+
+        profile = dataset.profile.copy()
+
+    profile.update(dict(
+        driver='GTiff',
+        dtype=rastercm.dtype,
+        nodata=None,
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress='LZW'
+    ))
+
+    tmp_file = '{}.tmp.tif'.format(os.path.splitext(mask_file)[0])
+
+    with rasterio.open(tmp_file, 'w', **profile) as dataset:
+        dataset.write(rastercm, 1)
+        dataset.update_tags(mask_decoder=decoder.name)
+
+    os.replace(tmp_file, mask_file)
+
+    return rastercm
+
+
+def _lc8sr_dilation(rastercm):
+    """Dilate the not clear area of LC8SR and fill its small holes."""
+    from scipy import ndimage
+    from skimage import morphology
+
+    notcleararea = numpy.greater(rastercm, 1)
+    dilated = numpy.empty_like(notcleararea)
+
+    ndimage.binary_dilation(notcleararea, structure=LC8SR_DILATION, output=dilated)
+    morphology.remove_small_holes(dilated, area_threshold=LC8SR_HOLE_AREA, connectivity=1, in_place=True)
+
+    # Clear area is the area with valid data and with no Cloud or Snow
+    numpy.bitwise_and(rastercm, 1, out=rastercm)
+    rastercm[dilated] = 2
+
+    return rastercm
+
+
+@mask_decoder('LC8SR', post_process=_lc8sr_dilation, halo=LC8SR_HALO)
+def landsat8_pixel_qa(values):
+    """
+    Decode LC8SR pixel_qa.
+
+    The table keeps the flags before the dilation: bit 0 marks valid data and
+    bit 1 marks not clear (cloud, shadow, snow, cirrus, saturation).
+    """
+    # Input pixel_qa codes
+    fill    = 1 				# warped images have 0 as fill area
+    terrain = 2					# 0000 0000 0000 0010
+    radsat  = 4+8				# 0000 0000 0000 1100
+    cloud   = 16+32+64			# 0000 0000 0110 0000
+    shadow  = 128+256			# 0000 0001 1000 0000
+    snowice = 512+1024			# 0000 0110 0000 0000
+    cirrus  = 2048+4096			# 0001 1000 0000 0000
+
+    # Mark the pixels that contain valid data
+    imagearea = values > fill
+    # Mark the pixels where the quality criteria is as follows
+    notcleararea = (values & radsat > 4) | \
+                   (values & cloud > 64) | \
+                   (values & shadow > 256) | \
+                   (values & snowice > 512) | \
+                   (values & cirrus > 4096)
+
+    return imagearea + 2 * notcleararea
+
+
+@mask_decoder('MOD13Q1', 'MYD13Q1')
+def modis_pixel_reliability(values):
+    # MOD13Q1 Pixel Reliability !!!!!!!!!!!!!!!!!!!!
+    # Note that 1 was added to this image in downloadModis because of warping
+    # Rank/Key Summary QA 		Description
+    # -1 		Fill/No Data 	Not Processed
+    # 0 		Good Data 		Use with confidence
+    # 1 		Marginal data 	Useful, but look at other QA information
+    # 2 		Snow/Ice 		Target covered with snow/ice
+    # 3 		Cloudy 			Target not visible, covered with cloud
+    codes = numpy.zeros(values.shape, dtype=numpy.uint8)
+    codes[[65535, 0, 1, 2, 3]] = [0,1,1,2,2]
+
+    return codes
+
+
+@mask_decoder('S2SR_SEN28', 'S2SR')
+def sentinel_scene_classification(values):
+    # S2 sen2cor - The generated classification map is specified as follows:
+    # Label Classification
+    #  0		NO_DATA
+    #  1		SATURATED_OR_DEFECTIVE
+    #  2		DARK_AREA_PIXELS
+    #  3		CLOUD_SHADOWS
+    #  4		VEGETATION
+    #  5		NOT_VEGETATED
+    #  6		WATER
+    #  7		UNCLASSIFIED
+    #  8		CLOUD_MEDIUM_PROBABILITY
+    #  9		CLOUD_HIGH_PROBABILITY
+    # 10		THIN_CIRRUS
+    # 11		SNOW
+    codes = numpy.zeros(values.shape, dtype=numpy.uint8)
+    # 0 1 2 3 4 5 6 7 8 9 10 11
+    codes[:12] = [0,0,2,2,1,1,1,2,2,2,1, 1]
+
+    return codes
+
+
+@mask_decoder('S2_SCL_COVER')
+def sentinel_cloud_cover(values):
+    """
+    Decode the Sentinel SCL as the catalog cloud cover does:
+    saturated, dark area, shadows, medium/high probability clouds and cirrus are cloud.
+    """
+    codes = numpy.ones(values.shape, dtype=numpy.uint8)
+    codes[0] = 0
+    codes[[1, 2, 3, 8, 9, 10]] = 2
+
+    return codes
+
+
+@mask_decoder('CB4_AWFI', 'CB4_MUX')
+def cbers_quality(values):
+    # Key 		Summary QA 		Description
+    # 0 		Fill/No Data 	Not Processed
+    # 127 		Good Data 		Use with confidence
+    # 255 		Cloudy 			Target not visible, covered with cloud
+    return numpy.select([values == 127, values == 255], [1, 2], 0)
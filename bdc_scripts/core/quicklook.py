@@ -0,0 +1,130 @@
+"""
+Defines the quick look generation of scenes and datacubes.
+
+The bands are read already decimated to the quick look size (``out_shape``),
+so GDAL takes the closest overview of COG files instead of reading the full
+resolution raster. Percentile stretches are evaluated over a sample of the
+decimated values.
+"""
+
+# Python Native
+import math
+import os
+# 3rdparty
+from numpngw import write_png
+from rasterio.enums import Resampling
+import numpy
+import rasterio
+
+
+# Number of lines of quick look image
+QUICK_LOOK_SIZE = 768
+
+# Maximum number of pixels used to evaluate the percentile stretch
+STRETCH_SAMPLE_SIZE = 100000
+
+# Size of quick look pyramid tiles
+QUICK_LOOK_TILE_SIZE = 256
+
+
+def generate_quicklook(pngname, files, stretch=None, nodata=None, size=QUICK_LOOK_SIZE,
+                       resampling=Resampling.bilinear, tiles_dir=None):
+    """
+    Generate a PNG quick look from the given files.
+
+    Each band of the files is a channel of quick look, in order. The image keeps
+    the aspect ratio of the first file, with ``size`` lines.
+
+    Args:
+        pngname (str) - Path to the PNG file
+        files (list) - Path to the files. Single band files (i.e red, green, blue) or a RGB file
+        stretch (str) - How values are converted to 1-255.
+            "percentile" uses the 1 and 99 percentiles of image, "scale" uses 0-10000 reflectances
+            and None keeps the values (8-bit images)
+        nodata (int|float) - Nodata value of files. Default is any value lower or equal 0
+        size (int) - Number of lines of quick look
+        resampling (Resampling) - Resampling used to decimate the files
+        tiles_dir (str) - When set, also write a tile pyramid of quick look in the directory
+
+    Returns:
+        Path to the PNG file
+    """
+    with rasterio.open(files[0]) as src:
+        numlin = size
+        numcol = int(float(src.width)/float(src.height)*numlin)
+
+    channels = []
+
+    for file in files:
+        with rasterio.open(file) as src:
+            rasters = src.read(out_shape=(src.count, numlin, numcol), resampling=resampling)
+
+        channels.extend(_stretch(raster, stretch, nodata) for raster in rasters)
+
+    image = numpy.dstack(channels)
+
+    write_png(pngname, image, transparent=(0, 0, 0))
+
+    if tiles_dir:
+        generate_tiles(image, tiles_dir)
+
+    return pngname
+
+
+def generate_tiles(image, directory, tile_size=QUICK_LOOK_TILE_SIZE):
+    """
+    Write a tile pyramid (``<zoom>/<x>/<y>.png``) of quick look image, used by the web viewer.
+
+    The zoom 0 fits the whole image in a single tile and the last zoom is the
+    quick look resolution.
+
+    Returns:
+        Number of zoom levels
+    """
+    max_zoom = max(0, math.ceil(math.log2(max(image.shape[:2]) / tile_size)))
+
+    for zoom in range(max_zoom + 1):
+        step = 2 ** (max_zoom - zoom)
+        level = image[::step, ::step]
+
+        for row_off in range(0, level.shape[0], tile_size):
+            for col_off in range(0, level.shape[1], tile_size):
+                tile = level[row_off:row_off + tile_size, col_off:col_off + tile_size]
+
+                tile_dir = os.path.join(directory, str(zoom), str(col_off // tile_size))
+                os.makedirs(tile_dir, exist_ok=True)
+
+                write_png(os.path.join(tile_dir, '{}.png'.format(row_off // tile_size)),
+                          numpy.ascontiguousarray(tile), transparent=(0, 0, 0))
+
+    return max_zoom + 1
+
+
+def _stretch(raster, stretch, nodata):
+    """Convert the raster to 1-255 values, using 0 as nodata."""
+    invalid = raster <= 0 if nodata is None else raster == nodata
+
+    if stretch == 'percentile':
+        values = raster[raster > 0]
+
+        if values.size == 0:
+            return numpy.zeros(raster.shape, dtype=numpy.uint8)
+
+        sample = values[::max(1, values.size // STRETCH_SAMPLE_SIZE)]
+        p1, p99 = numpy.percentile(sample, (1, 99))
+
+        # Convert minimum and maximum values to 1,255 - 0 is nodata
+        scaled = numpy.clip(raster, p1, p99).astype(numpy.float32)
+        scaled -= p1
+        scaled *= 254. / max(p99 - p1, 1e-6)
+        scaled += 1
+    elif stretch == 'scale':
+        # Rescale reflectances to 0-255 values
+        scaled = raster.astype(numpy.float32)/10000.*255.
+    else:
+        scaled = raster
+
+    image = numpy.clip(scaled, 0, 255).astype(numpy.uint8)
+    image[invalid] = 0
+
+    return image
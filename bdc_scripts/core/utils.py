@@ -1,13 +1,20 @@
 # Python Native
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from json import loads as json_parser
-from os import remove as resource_remove, path as resource_path
+from os import remove as resource_remove, replace as resource_replace, path as resource_path
 from zlib import error as zlib_error
 from zipfile import BadZipfile, ZipFile
+import hashlib
 import logging
+import math
+import threading
+import time
 
 # 3rdparty
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
-from skimage.transform import resize
 import boto3
 import gdal
 import numpy
@@ -23,66 +30,278 @@ def get_credentials():
         return json_parser(f.read())
 
 
-def extractall(file):
-    archive = ZipFile(file, 'r')
-    archive.extractall(resource_path.dirname(file))
-    archive.close()
+def extractall(file, members=None):
+    """
+    Extract the zip file in its directory.
+
+    Members already extracted (same size) are skipped, so an interrupted extraction
+    continues where it stopped.
+
+    Args:
+        file (str) - Path to the zip file
+        members (list) - Names of members to extract. Default is all members
+
+    Returns:
+        list Names of extracted members
+    """
+    directory = resource_path.dirname(file)
+    extracted = []
+
+    with ZipFile(file, 'r') as archive:
+        infos = archive.infolist()
+
+        if members is not None:
+            members = set(members)
+            infos = [info for info in infos if info.filename in members]
+
+        for info in infos:
+            target = resource_path.join(directory, info.filename)
 
+            if not info.is_dir() and resource_path.exists(target) and resource_path.getsize(target) == info.file_size:
+                continue
 
-def is_valid(file):
+            archive.extract(info, directory)
+            extracted.append(info.filename)
+
+    return extracted
+
+
+def is_valid(file, full=False):
+    """
+    Check the integrity of zip file.
+
+    By default, only the structure is checked: the central directory must be readable
+    and each member must start with a local header and fit before the central
+    directory. It reads a few bytes per member instead of the whole file, and detects
+    truncated or partially written files.
+
+    Args:
+        file (str) - Path to the zip file
+        full (bool) - Also decompress every member and check its CRC (reads the whole file)
+
+    Returns:
+        bool
+    """
     try:
-        archive = ZipFile(file, 'r')
-        try:
-            corrupt = archive.testzip()
-        except zlib_error:
-            corrupt = True
-        archive.close()
-    except BadZipfile:
-        corrupt = True
+        with ZipFile(file, 'r') as archive:
+            if full:
+                return archive.testzip() is None
+
+            return _check_zip_structure(archive)
+    except (BadZipfile, zlib_error, OSError, EOFError):
+        return False
+
+
+# Signature and size of zip local file header
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _check_zip_structure(archive):
+    """Check that every member of central directory points to a complete local entry."""
+    # Offset of central directory, where the member data ends
+    end = archive.start_dir
+
+    for info in archive.infolist():
+        archive.fp.seek(info.header_offset)
+        header = archive.fp.read(ZIP_LOCAL_HEADER_SIZE)
+
+        if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+            return False
+
+        name_length, extra_length = int.from_bytes(header[26:28], 'little'), int.from_bytes(header[28:30], 'little')
 
-    return not corrupt
+        if info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length + info.compress_size > end:
+            return False
 
+    return True
+
+
+# Overview levels of Cloud Optimized GeoTIFF files
+COG_OVERVIEWS = [2, 4, 8, 16, 32, 64]
 
-def generate_cogs(input_data_set_path, file_path):
+
+def generate_cogs(input_data_set_path, file_path, compress=None, predictor=None, resampling=None, block_size=None):
     """
     Generate Cloud Optimized GeoTIFF files (COG)
 
+    The data set is copied block by block into a tiled file, the overviews are
+    built from it into an external file and then both are copied into the COG
+    layout. The full raster is never held in memory, so the input may be the
+    output file itself.
+
     Args:
         input_data_set_path (str) - Path to the input data set
         file_path (str) - Target data set filename
+        compress (str) - Compression method (LZW, DEFLATE, ZSTD). Default is Config.COG_COMPRESS
+        predictor (int) - TIFF predictor (1 none, 2 horizontal, 3 floating point). Default is Config.COG_PREDICTOR
+        resampling (str) - Overview resampling. Use NEAREST for quality bands. Default is Config.COG_RESAMPLING
+        block_size (int) - Size of COG tiles. Default is Config.COG_BLOCK_SIZE
 
     Returns:
         Path to COG
     """
+    compress = compress or Config.COG_COMPRESS
+    predictor = predictor or Config.COG_PREDICTOR
+    resampling = resampling or Config.COG_RESAMPLING
+    block_size = block_size or Config.COG_BLOCK_SIZE
 
     src_ds = gdal.Open(input_data_set_path, gdal.GA_ReadOnly)
 
     if src_ds is None:
         raise ValueError('Could not open data set "{}"'.format(input_data_set_path))
 
-    driver = gdal.GetDriverByName('MEM')
+    options = [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(block_size),
+        'BLOCKYSIZE={}'.format(block_size),
+        'COMPRESS={}'.format(compress),
+        'BIGTIFF=IF_SAFER'
+    ]
 
-    src_band = src_ds.GetRasterBand(1)
-    data_set = driver.Create('', src_ds.RasterXSize, src_ds.RasterYSize, 1, src_band.DataType)
-    data_set.SetGeoTransform( src_ds.GetGeoTransform() )
-    data_set.SetProjection( src_ds.GetProjection() )
+    if predictor > 1:
+        options.append('PREDICTOR={}'.format(predictor))
 
-    data_set_band = data_set.GetRasterBand(1)
+    tiled_file = '{}.tiled.tif'.format(file_path)
+    cog_file = '{}.cog.tif'.format(file_path)
 
-    data_set_band.WriteArray( src_band.ReadAsArray() )
-    data_set.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+    try:
+        # Copy the source block by block
+        tiled_ds = gdal.Translate(tiled_file, src_ds, format='GTiff', creationOptions=options)
 
-    driver = gdal.GetDriverByName('GTiff')
-    dst_ds = driver.CreateCopy(file_path, data_set, options=["COPY_SRC_OVERVIEWS=YES", "TILED=YES", "COMPRESS=LZW"])
+        del src_ds
+        del tiled_ds
 
-    del src_ds
-    del data_set
-    del dst_ds
+        # Open as read only, so the overviews are written in the external file (.ovr)
+        tiled_ds = gdal.Open(tiled_file, gdal.GA_ReadOnly)
+
+        with _gdal_options(COMPRESS_OVERVIEW=compress,
+                           PREDICTOR_OVERVIEW=str(predictor) if predictor > 1 else None,
+                           GDAL_TIFF_OVR_BLOCKSIZE=str(block_size)):
+            tiled_ds.BuildOverviews(resampling.upper(), COG_OVERVIEWS)
+
+        driver = gdal.GetDriverByName('GTiff')
+        dst_ds = driver.CreateCopy(cog_file, tiled_ds, options=['COPY_SRC_OVERVIEWS=YES'] + options)
+
+        del tiled_ds
+        del dst_ds
+
+        resource_replace(cog_file, file_path)
+    finally:
+        for file in [tiled_file, '{}.ovr'.format(tiled_file), cog_file]:
+            remove_file(file)
 
     return file_path
 
 
-def upload_file(file_name, bucket='bdc-ds-datacube', object_name=None):
+def generate_cogs_parallel(conversions, max_workers=None):
+    """
+    Generate Cloud Optimized GeoTIFF files concurrently.
+
+    The largest inputs start first, so the conversion time is not dominated by a
+    large band started last. GDAL releases the GIL while converting, so the
+    conversions run in threads.
+
+    Args:
+        conversions (list) - Arguments of generate_cogs (dict with input_data_set_path, file_path and options)
+        max_workers (int) - Number of concurrent conversions. Default is Config.PUBLISH_THREADS
+
+    Yields:
+        Tuple with the conversion and the COG metadata (raster and chunk sizes), as each conversion finishes
+    """
+    conversions = sorted(conversions, key=lambda c: _file_size(c['input_data_set_path']), reverse=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers or Config.PUBLISH_THREADS) as executor:
+        futures = {executor.submit(_generate_cog, **conversion): conversion for conversion in conversions}
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def _generate_cog(**conversion):
+    """Generate a COG file and retrieve its metadata."""
+    file_path = generate_cogs(**conversion)
+
+    data_set = gdal.Open(file_path, gdal.GA_ReadOnly)
+    chunk_x, chunk_y = data_set.GetRasterBand(1).GetBlockSize()
+
+    metadata = dict(
+        file=file_path,
+        raster_size_x=data_set.RasterXSize,
+        raster_size_y=data_set.RasterYSize,
+        chunk_size_x=chunk_x,
+        chunk_size_y=chunk_y
+    )
+
+    del data_set
+
+    return metadata
+
+
+def _file_size(file_path):
+    try:
+        return resource_path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+class _gdal_options:
+    """
+    Set GDAL configuration options during a context.
+
+    The options are local to the current thread, since COG files may be generated concurrently.
+    Older GDAL bindings only have process wide options, so the contexts are serialized by a
+    lock while the options are set.
+    """
+    def __init__(self, **options):
+        self.options = options
+        self.previous = dict()
+
+    def __enter__(self):
+        if _gdal_options_lock is not None:
+            _gdal_options_lock.acquire()
+
+        for key, value in self.options.items():
+            self.previous[key] = _get_config_option(key, None)
+            _set_config_option(key, value)
+
+    def __exit__(self, *args):
+        try:
+            for key, value in self.previous.items():
+                _set_config_option(key, value)
+        finally:
+            if _gdal_options_lock is not None:
+                _gdal_options_lock.release()
+
+
+# Thread local options are not available in older GDAL bindings
+_get_config_option = getattr(gdal, 'GetThreadLocalConfigOption', gdal.GetConfigOption)
+_set_config_option = getattr(gdal, 'SetThreadLocalConfigOption', gdal.SetConfigOption)
+_gdal_options_lock = None if hasattr(gdal, 'SetThreadLocalConfigOption') else threading.Lock()
+
+
+@lru_cache()
+def get_s3_client():
+    """
+    Retrieve the S3 client shared by uploads.
+
+    The client is thread safe and keeps its connection pool between uploads.
+    """
+    return boto3.client('s3',
+                        region_name=Config.AWS_REGION_NAME,
+                        aws_access_key_id=Config.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=Config.AWS_SECRET_ACCESS_KEY,
+                        config=BotoConfig(max_pool_connections=Config.UPLOAD_THREADS * Config.UPLOAD_CONCURRENCY))
+
+
+def get_transfer_config():
+    """Retrieve the multipart settings of uploads."""
+    return TransferConfig(multipart_threshold=Config.UPLOAD_CHUNK_SIZE,
+                          multipart_chunksize=Config.UPLOAD_CHUNK_SIZE,
+                          max_concurrency=Config.UPLOAD_CONCURRENCY)
+
+
+def upload_file(file_name, bucket='bdc-ds-datacube', object_name=None, skip_existing=True):
     """
     Upload a file to an S3 bucket
 
@@ -92,6 +311,7 @@ def upload_file(file_name, bucket='bdc-ds-datacube', object_name=None):
         file_name (str|_io.TextIO): File to upload
         bucket (str): Bucket to upload to
         object_name (str): S3 object name. If not specified then file_name is used
+        skip_existing (bool): Skip the upload when the object has the same size and ETag of file
     """
 
     # If S3 object_name was not specified, use file_name
@@ -99,15 +319,91 @@ def upload_file(file_name, bucket='bdc-ds-datacube', object_name=None):
         object_name = file_name
 
     # Upload the file
-    s3_client = boto3.client('s3', region_name=Config.AWS_REGION_NAME, aws_access_key_id=Config.AWS_ACCESS_KEY_ID, aws_secret_access_key=Config.AWS_SECRET_ACCESS_KEY)
+    s3_client = get_s3_client()
     try:
-        s3_client.upload_file(file_name, bucket, object_name)
+        if skip_existing and isinstance(file_name, str) and is_uploaded(file_name, bucket, object_name):
+            logging.info('{} already uploaded to {}. Skipping'.format(file_name, object_name))
+            return True
+
+        s3_client.upload_file(file_name, bucket, object_name, Config=get_transfer_config())
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
+def upload_files(files, bucket, max_workers=None):
+    """
+    Upload files to an S3 bucket concurrently, logging the throughput.
+
+    Args:
+        files (list): Tuples with file and S3 object name
+        bucket (str): Bucket to upload to
+        max_workers (int): Number of files uploaded at same time. Default is Config.UPLOAD_THREADS
+
+    Returns:
+        bool True when all files were uploaded
+    """
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers or Config.UPLOAD_THREADS) as executor:
+        results = list(executor.map(lambda entry: upload_file(entry[0], bucket, entry[1]), files))
+
+    elapsed = max(time.time() - start, 1e-6)
+    total = sum(_file_size(file_name) for file_name, _ in files)
+
+    logging.info('Uploaded {} files ({:.1f} MB) in {:.1f}s - {:.1f} MB/s'.format(
+        len(files), total / 1024 ** 2, elapsed, total / 1024 ** 2 / elapsed))
+
+    return all(results)
+
+
+def is_uploaded(file_name, bucket, object_name):
+    """
+    Check if the S3 object has the same content of file, comparing size and ETag.
+
+    The ETag of multipart uploads is the MD5 of the parts MD5, so it is evaluated
+    with the part size used by the uploads.
+    """
+    try:
+        head = get_s3_client().head_object(Bucket=bucket, Key=object_name)
+    except ClientError:
+        return False
+
+    if head['ContentLength'] != _file_size(file_name):
+        return False
+
+    etag = head['ETag'].strip('"')
+
+    if '-' not in etag:
+        return etag == _md5(file_name)
+
+    parts = int(etag.split('-')[1])
+    part_size = Config.UPLOAD_CHUNK_SIZE
+
+    if parts != max(1, math.ceil(head['ContentLength'] / part_size)):
+        # Uploaded with a different part size
+        return False
+
+    digests = []
+
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            digests.append(hashlib.md5(chunk).digest())
+
+    return etag == '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def _md5(file_name, chunk_size=8 * 1024 * 1024):
+    md5 = hashlib.md5()
+
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
 def remove_file(file_path: str):
     """
     Remove file if exists
@@ -119,56 +415,124 @@ def remove_file(file_path: str):
         resource_remove(file_path)
 
 
-def generate_evi_ndvi(red_band: str, nir_band: str, blue_bland: str, evi_name: str, ndvi_name: str):
+# Vegetation indices computed by generate_vegetation_indices.
+# Each index is defined by its bands and a function of their reflectances (0-1)
+VEGETATION_INDICES = {
+    'NDVI': (('nir', 'red'), lambda b: (b['nir'] - b['red']) / (b['nir'] + b['red'] + 0.0001)),
+    'EVI': (('nir', 'red', 'blue'), lambda b: 2.5 * (b['nir'] - b['red']) / (b['nir'] + 6. * b['red'] - 7.5 * b['blue'] + 1)),
+    'NBR': (('nir', 'swir2'), lambda b: (b['nir'] - b['swir2']) / (b['nir'] + b['swir2'] + 0.0001)),
+    'NDWI': (('green', 'nir'), lambda b: (b['green'] - b['nir']) / (b['green'] + b['nir'] + 0.0001)),
+    'SAVI': (('nir', 'red'), lambda b: 1.5 * (b['nir'] - b['red']) / (b['nir'] + b['red'] + 0.5)),
+}
+
+
+def generate_vegetation_indices(bands: dict, outputs: dict, reference: str = 'red', block_size: int = 512):
     """
-    Generate Normalized Difference Vegetation Index (NDVI) and Enhanced Vegetation Index (EVI)
+    Generate vegetation indices block by block.
+
+    All indices are computed from the same reads. Bands with a different resolution
+    (i.e Sentinel nir at 20m) are resampled (bilinear) by GDAL while reading each block
+    into the grid of reference band.
 
     Args:
-        red_band: Path to the RED band
-        nir_band: Path to the NIR band
-        blue_bland: Path to the BLUE band
-        evi_name: Path to save EVI file
-        ndvi_name: Path to save NDVI file
+        bands (dict) - Path to the bands by common name (red, nir, blue, green, swir2)
+        outputs (dict) - Path to save each index by name (NDVI, EVI, NBR, NDWI, SAVI)
+        reference (str) - Band which defines the output grid
+        block_size (int) - Size of blocks
 
+    Raises:
+        ValueError when an index is not supported or its bands are missing
     """
-    data_set = gdal.Open(red_band, gdal.GA_ReadOnly)
-    raster_xsize = data_set.RasterXSize
-    raster_ysize = data_set.RasterYSize
-    red = data_set.GetRasterBand(1).ReadAsArray(0, 0, data_set.RasterXSize, data_set.RasterYSize).astype(numpy.float32)/10000.
+    required = set([reference])
 
-    # Close data_set
-    del data_set
+    for index in outputs:
+        if index not in VEGETATION_INDICES:
+            raise ValueError('Vegetation index {} not supported'.format(index))
 
-    data_set = gdal.Open(nir_band, gdal.GA_ReadOnly)
-    nir = data_set.GetRasterBand(1).ReadAsArray(0, 0, data_set.RasterXSize, data_set.RasterYSize).astype(numpy.float32)/10000.
-    nir = resize(nir, red.shape, order=1, preserve_range=True).astype(numpy.float32)
+        required.update(VEGETATION_INDICES[index][0])
 
-    del data_set
-    data_set = gdal.Open(blue_bland, gdal.GA_ReadOnly)
-    blue = data_set.GetRasterBand(1).ReadAsArray(0, 0, data_set.RasterXSize, data_set.RasterYSize).astype(numpy.float32)/10000.
+    missing = required.difference(bands)
 
-    # Create the ndvi image data_set
-    remove_file(ndvi_name)
+    if missing:
+        raise ValueError('Missing bands {} to generate {}'.format(', '.join(sorted(missing)), ', '.join(outputs)))
+
+    data_sets = {band: gdal.Open(bands[band], gdal.GA_ReadOnly) for band in required}
+    reference_data_set = data_sets[reference]
+    raster_xsize = reference_data_set.RasterXSize
+    raster_ysize = reference_data_set.RasterYSize
 
     driver = gdal.GetDriverByName('GTiff')
 
-    raster_ndvi = (10000 * (nir - red) / (nir + red + 0.0001)).astype(numpy.int16)
-    ndvi_data_set = driver.Create(ndvi_name, raster_xsize, raster_ysize, 1, gdal.GDT_Int16, options=['COMPRESS=LZW',
-                                                                                                        'TILED=YES'])
-    ndvi_data_set.SetGeoTransform(data_set.GetGeoTransform())
-    ndvi_data_set.SetProjection(data_set.GetProjection())
-    ndvi_data_set.GetRasterBand(1).WriteArray(raster_ndvi)
-    del ndvi_data_set
-
-    # Create the evi image data set
-    remove_file(evi_name)
-    evi_data_set = driver.Create(evi_name, raster_xsize, raster_ysize, 1, gdal.GDT_Int16, options=['COMPRESS=LZW',
-                                                                                                    'TILED=YES'])
-    raster_evi = (10000 * 2.5 * (nir - red)/(nir + 6. * red - 7.5 * blue + 1)).astype(numpy.int16)
-    evi_data_set.SetGeoTransform(data_set.GetGeoTransform())
-    evi_data_set.SetProjection(data_set.GetProjection())
-    evi_data_set.GetRasterBand(1).WriteArray(raster_evi)
-    del raster_evi
-    del evi_data_set
+    output_data_sets = {}
 
-    del data_set
+    for index, file_path in outputs.items():
+        remove_file(file_path)
+
+        output_data_set = driver.Create(file_path, raster_xsize, raster_ysize, 1, gdal.GDT_Int16,
+                                        options=['COMPRESS=LZW', 'TILED=YES'])
+        output_data_set.SetGeoTransform(reference_data_set.GetGeoTransform())
+        output_data_set.SetProjection(reference_data_set.GetProjection())
+
+        output_data_sets[index] = output_data_set
+
+    for yoff in range(0, raster_ysize, block_size):
+        ysize = min(block_size, raster_ysize - yoff)
+
+        for xoff in range(0, raster_xsize, block_size):
+            xsize = min(block_size, raster_xsize - xoff)
+
+            block = {
+                band: _read_block(data_set, raster_xsize, raster_ysize, xoff, yoff, xsize, ysize)
+                for band, data_set in data_sets.items()
+            }
+
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                for index, output_data_set in output_data_sets.items():
+                    raster = (10000 * VEGETATION_INDICES[index][1](block)).astype(numpy.int16)
+
+                    output_data_set.GetRasterBand(1).WriteArray(raster, xoff, yoff)
+
+    # Close data sets
+    for index in list(output_data_sets):
+        output_data_sets[index].FlushCache()
+        del output_data_sets[index]
+
+    del reference_data_set
+    data_sets.clear()
+
+
+def _read_block(data_set, raster_xsize, raster_ysize, xoff, yoff, xsize, ysize):
+    """Read a block of reference grid from data set as reflectance (float32), resampling when resolutions differ."""
+    band = data_set.GetRasterBand(1)
+
+    if data_set.RasterXSize == raster_xsize and data_set.RasterYSize == raster_ysize:
+        raster = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    else:
+        ratio_x = data_set.RasterXSize / raster_xsize
+        ratio_y = data_set.RasterYSize / raster_ysize
+
+        src_xoff = int(xoff * ratio_x)
+        src_yoff = int(yoff * ratio_y)
+        src_xsize = max(1, min(data_set.RasterXSize - src_xoff, int(round(xsize * ratio_x))))
+        src_ysize = max(1, min(data_set.RasterYSize - src_yoff, int(round(ysize * ratio_y))))
+
+        raster = band.ReadAsArray(src_xoff, src_yoff, src_xsize, src_ysize,
+                                  buf_xsize=xsize, buf_ysize=ysize, resample_alg=gdal.GRIORA_Bilinear)
+
+    return raster.astype(numpy.float32) / 10000.
+
+
+def generate_evi_ndvi(red_band: str, nir_band: str, blue_bland: str, evi_name: str, ndvi_name: str):
+    """
+    Generate Normalized Difference Vegetation Index (NDVI) and Enhanced Vegetation Index (EVI)
+
+    Args:
+        red_band: Path to the RED band
+        nir_band: Path to the NIR band
+        blue_bland: Path to the BLUE band
+        evi_name: Path to save EVI file
+        ndvi_name: Path to save NDVI file
+
+    """
+    generate_vegetation_indices(dict(red=red_band, nir=nir_band, blue=blue_bland),
+                                dict(NDVI=ndvi_name, EVI=evi_name))
@@ -275,10 +275,10 @@ class CubeBusiness:
 
 
     @classmethod
-    def maestro(cls, datacube, collections, tiles, start_date, end_date):
+    def maestro(cls, datacube, collections, tiles, start_date, end_date, **properties):
         from .maestro import Maestro
 
-        maestro = Maestro(datacube, collections, tiles, start_date, end_date)
+        maestro = Maestro(datacube, collections, tiles, start_date, end_date, **properties)
 
         maestro.orchestrate()
 
@@ -0,0 +1,155 @@
+"""
+Defines a content-addressed cache of warped merges.
+
+Datacubes sharing the same grid (i.e MEDIAN and STACK cubes of the same collections)
+warp exactly the same scenes. The cache stores each merge under a hash of its
+inputs (assets, grid and resampling), so that the next datacube only links
+the cached file instead of reprojecting the assets again.
+
+The cache is bounded by ``Config.MERGE_CACHE_MAX_SIZE`` bytes. The least recently
+used entries are evicted first.
+"""
+
+# Python Native
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+# BDC Scripts
+from bdc_scripts.config import Config
+
+
+class MergeCache:
+    """
+    Cache of merged files.
+
+    Each entry is a hard link of the merged file (``<key>.tif``), so the cache
+    does not duplicate data on disk, and its metadata (``<key>.json``) with
+    efficacy, cloud ratio and footprint.
+
+    Example:
+        >>> cache = MergeCache()
+        >>> key = MergeCache.key(assets=[...], cols=6400, rows=6400, ...)
+        >>> metadata = cache.get(key, '/path/to/merge.tif')
+        >>> if metadata is None:
+        >>>     # Warp and merge into /path/to/merge.tif
+        >>>     cache.put(key, '/path/to/merge.tif', dict(efficacy=efficacy, ...))
+    """
+    def __init__(self, directory: str = None, max_size: int = None):
+        self.directory = directory or Config.MERGE_CACHE_DIR
+        self.max_size = max_size if max_size is not None else Config.MERGE_CACHE_MAX_SIZE
+
+    @staticmethod
+    def key(**parameters) -> str:
+        """Generate the cache key of a merge from its parameters."""
+        content = json.dumps(parameters, sort_keys=True, default=str)
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _entry(self, key: str):
+        return os.path.join(self.directory, '{}.tif'.format(key)), os.path.join(self.directory, '{}.json'.format(key))
+
+    def get(self, key: str, target: str):
+        """
+        Retrieve a merge from cache into target file.
+
+        Returns:
+            dict The merge metadata or None when key is not cached.
+        """
+        file, metadata_file = self._entry(key)
+
+        if not os.path.exists(file) or not os.path.exists(metadata_file):
+            return None
+
+        try:
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+
+            _link(file, target)
+
+            # Mark entry as recently used
+            os.utime(file)
+        except (OSError, ValueError) as e:
+            logging.warning('Could not retrieve merge {} from cache - {}'.format(key, e))
+            return None
+
+        logging.info('Merge {} retrieved from cache'.format(target))
+
+        return metadata
+
+    def put(self, key: str, file: str, metadata: dict):
+        """Add the merged file and its metadata into cache and evict the least recently used entries."""
+        os.makedirs(self.directory, exist_ok=True)
+
+        cache_file, metadata_file = self._entry(key)
+
+        try:
+            _link(file, cache_file)
+
+            tmp_file = _tmp_name(metadata_file)
+
+            with open(tmp_file, 'w') as f:
+                json.dump(metadata, f)
+
+            os.replace(tmp_file, metadata_file)
+        except OSError as e:
+            logging.warning('Could not cache merge {} - {}'.format(file, e))
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        entries = []
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tif'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another worker meanwhile
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logging.info('Evicting merge {} from cache'.format(path))
+
+            for file in [path, '{}.json'.format(path[:-len('.tif')])]:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+
+            total -= size
+
+
+def _link(source: str, target: str):
+    """Hard link source into target atomically, copying when they are in different file systems."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    tmp_file = _tmp_name(target)
+
+    try:
+        try:
+            os.link(source, tmp_file)
+        except OSError:
+            shutil.copyfile(source, tmp_file)
+
+        os.replace(tmp_file, target)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def _tmp_name(target: str) -> str:
+    """Generate a temporary name for target, unique among the processes and threads writing the cache."""
+    return '{}.{}.{}.tmp'.format(target, os.getpid(), uuid.uuid4().hex)
@@ -0,0 +1,106 @@
+"""
+Defines the temporal composite functions used by datastorm blend.
+
+A composite function receives the stack of scenes of a block as a float32 array
+with shape (scenes, rows, cols), ordered by efficacy, where the masked pixels
+(fill or cloud) are NaN. It must return the composite block with shape (rows, cols),
+using NaN where there is no valid observation.
+
+New functions can be registered with :func:`composite_function`:
+
+    >>> @composite_function('MAX')
+    >>> def maximum(stack):
+    >>>     return numpy.nanmax(stack, axis=0)
+
+Percentile composites are available as ``P<q>``, i.e ``P25`` or ``P90``.
+"""
+
+# Python Native
+from functools import partial
+import re
+# 3rdparty
+import numpy
+
+
+COMPOSITE_FUNCTIONS = dict()
+
+
+def composite_function(name: str):
+    """Register a composite function in blend engine."""
+    def _register(function):
+        COMPOSITE_FUNCTIONS[name.upper()] = function
+
+        return function
+
+    return _register
+
+
+def get_composite_function(name: str):
+    """
+    Retrieve a registered composite function by name.
+
+    Raises:
+        ValueError when composite function is not supported.
+    """
+    name = name.upper()
+
+    if name in COMPOSITE_FUNCTIONS:
+        return COMPOSITE_FUNCTIONS[name]
+
+    match = re.match(r'^P(\d{1,2})$', name)
+
+    if match:
+        return partial(percentile, q=int(match.group(1)))
+
+    raise ValueError('Composite function "{}" not supported'.format(name))
+
+
+def get_cube_id(datacube: str, function: str) -> str:
+    """
+    Retrieve the identifier of datacube for the given composite function.
+
+    Example:
+        >>> get_cube_id('C64m_MEDIAN', 'STACK')
+        'C64m_STACK'
+    """
+    functions = '|'.join(list(COMPOSITE_FUNCTIONS.keys()) + ['WARPED', r'P\d{1,2}'])
+
+    return re.sub(r'({})$'.format(functions), '', datacube) + function.upper()
+
+
+@composite_function('MEDIAN')
+def median(stack):
+    return _nan_reduce(numpy.nanmedian, stack)
+
+
+@composite_function('MEAN')
+def mean(stack):
+    return _nan_reduce(numpy.nanmean, stack)
+
+
+@composite_function('STACK')
+def first_valid(stack):
+    """Take the first valid pixel, following the order of the stack (best efficacy first)."""
+    order = numpy.argmax(~numpy.isnan(stack), axis=0)
+
+    return numpy.take_along_axis(stack, order[numpy.newaxis], axis=0)[0]
+
+
+def percentile(stack, q: int):
+    return _nan_reduce(partial(numpy.nanpercentile, q=q), stack)
+
+
+def _nan_reduce(function, stack):
+    """
+    Reduce the stack only on pixels with any valid observation.
+
+    Pixels without valid observation are expected in blend and remain NaN. Skipping them
+    avoids the numpy warnings of all-NaN slices, without changing the warning filters,
+    which are global to the process and not safe to change while blend runs in threads.
+    """
+    valid = ~numpy.all(numpy.isnan(stack), axis=0)
+
+    result = numpy.full(stack.shape[1:], numpy.nan, dtype=stack.dtype)
+    result[valid] = function(stack[:, valid], axis=0)
+
+    return result
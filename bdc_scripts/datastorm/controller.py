@@ -40,6 +40,9 @@ class CubeProcessController(Resource):
         data = form.load(args)
 
         # proc = CubeBusiness.process(data['datacube'], data['collections'], data['tiles'], data['start_date'], data['end_date'])
-        proc = CubeBusiness.maestro(data['datacube'], data['collections'], data['tiles'], data['start_date'], data['end_date'])
+        proc = CubeBusiness.maestro(data['datacube'], data['collections'], data['tiles'],
+                                    data['start_date'], data['end_date'],
+                                    provenance=data['provenance'], incremental=data['incremental'],
+                                    scene_batched=data['scene_batched'])
 
         return proc
@@ -8,6 +8,7 @@ import numpy
 # BDC Scripts
 from bdc_db.models import Collection, Tile, Band, db
 from bdc_scripts.config import Config
+from .manifest import PeriodManifest
 
 
 def days_in_month(date):
@@ -147,7 +148,7 @@ class Maestro:
     tiles = []
     mosaics = dict()
 
-    def __init__(self, datacube: str, collections: List[str], tiles: List[str], start_date: str, end_date: str):
+    def __init__(self, datacube: str, collections: List[str], tiles: List[str], start_date: str, end_date: str, **properties):
         self.params = dict(
             datacube=datacube,
             collections=collections,
@@ -156,6 +157,8 @@ class Maestro:
             end_date=end_date
         )
 
+        self.params.update(properties)
+
     def orchestrate(self):
         self.datacube = Collection.query().filter(Collection.id == self.params['datacube']).one()
 
@@ -262,10 +265,23 @@ class Maestro:
         )
 
     def dispatch_celery(self):
+        """
+        Dispatch the celery tasks of warp, merge and blend for each tile period.
+
+        In incremental mode, the dates already merged with the same assets
+        (see :class:`bdc_scripts.datastorm.manifest.PeriodManifest`) are not warped again,
+        the periods without new scenes are skipped and the blend only updates the
+        blocks touched by the new merges.
+
+        In scene batched mode, a single task warps and merges all bands of a date.
+        """
         from celery import group, chain
-        from bdc_scripts.datastorm.tasks import blend, warp_merge, publish
+        from bdc_scripts.datastorm.tasks import blend, warp_merge, warp_merge_scene, publish
         self.prepare_merge()
 
+        incremental = self.params.get('incremental', False)
+        scene_batched = self.params.get('scene_batched', False)
+
         datacube = self.datacube.id
 
         if datacube is None:
@@ -291,11 +307,27 @@ class Maestro:
                 cols = self.mosaics[tileid]['periods'][period]['cols']
                 rows = self.mosaics[tileid]['periods'][period]['rows']
 
+                manifest = PeriodManifest(warped_datacube, tileid, period) if incremental else None
+
+                # Bands of each (collection, date) when scene batched
+                scenes = dict()
+
                 for band in bands:
                     collections = self.mosaics[tileid]['periods'][period]['scenes'][band.common_name]
 
                     for collection, merges in collections.items():
                         for merge_date, assets in merges.items():
+                            if manifest is not None and manifest.is_merged(band.common_name, collection, merge_date, assets):
+                                continue
+
+                            if scene_batched:
+                                scenes.setdefault((collection, merge_date), []).append(dict(
+                                    assets=assets,
+                                    resx=band.resolution_x,
+                                    resy=band.resolution_y
+                                ))
+                                continue
+
                             properties = dict(
                                 date=merge_date,
                                 dataset=collection,
@@ -308,7 +340,23 @@ class Maestro:
                             task = warp_merge.s(warped_datacube, tileid, period, assets, cols, rows, **properties)
                             merges_tasks.append(task)
 
-                task = chain(group(merges_tasks), blend.s())
+                for (collection, merge_date), band_assets in scenes.items():
+                    properties = dict(
+                        date=merge_date,
+                        dataset=collection,
+                        xmin=tile.min_x,
+                        ymax=tile.max_y,
+                        datacube=datacube
+                    )
+                    task = warp_merge_scene.s(warped_datacube, tileid, period, band_assets, cols, rows, **properties)
+                    merges_tasks.append(task)
+
+                # Nothing new to merge in period
+                if not merges_tasks:
+                    continue
+
+                task = chain(group(merges_tasks), blend.s(provenance=self.params.get('provenance', False),
+                                                          incremental=incremental))
                 blends.append(task)
 
             # task = chain(group(blends), publish.s())
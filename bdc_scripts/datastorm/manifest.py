@@ -0,0 +1,68 @@
+"""
+Defines the manifest of merges of a datacube period.
+
+The manifest keeps the merge results (files, efficacy, cloud ratio, assets and
+footprint) of each band and date of a tile period, so that a period can be
+re-blended incrementally when a new scene arrives, without warping again the
+scenes already merged.
+"""
+
+# Python Native
+import json
+import os
+# BDC Scripts
+from bdc_scripts.config import Config
+
+
+class PeriodManifest:
+    """
+    Manifest of merges of a period, stored as ``manifest.json`` in the period
+    folder of the warped datacube.
+
+    Example:
+        >>> manifest = PeriodManifest('C64m_WARPED', '089098', '2019-01-01_2019-01-31')
+        >>> manifest.update(merges)
+        >>> manifest.save()
+    """
+    def __init__(self, warped_datacube: str, tile_id: str, period: str):
+        self.file = os.path.join(Config.DATA_DIR, 'Repository/collections/cubes/{}/{}/{}/manifest.json'.format(
+            warped_datacube, tile_id, period))
+        self._merges = dict()
+
+        if os.path.exists(self.file):
+            with open(self.file) as f:
+                self._merges = json.load(f)
+
+    def merges(self):
+        """List all merge results of period which still exist on disk."""
+        return [
+            merge
+            for band_merges in self._merges.values()
+            for merge in band_merges.values()
+            if os.path.exists(merge['file'])
+        ]
+
+    def is_merged(self, band: str, dataset: str, date: str, assets: list) -> bool:
+        """Check if the date was already merged using the same assets."""
+        merge = self._merges.get(band, dict()).get('{}{}'.format(date, dataset))
+
+        if merge is None or not os.path.exists(merge['file']):
+            return False
+
+        return sorted(merge.get('assets', [])) == sorted(asset['link'] for asset in assets)
+
+    def update(self, merges: list):
+        """Add or replace the given merge results."""
+        for merge in merges:
+            self._merges.setdefault(merge['band'], dict())[merge['date']] = merge
+
+    def save(self):
+        """Write the manifest atomically."""
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+
+        tmp_file = '{}.tmp'.format(self.file)
+
+        with open(tmp_file, 'w') as f:
+            json.dump(self._merges, f)
+
+        os.replace(tmp_file, self.file)
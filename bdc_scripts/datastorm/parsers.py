@@ -26,4 +26,7 @@ class DataCubeProcessParser(Schema):
     collections = fields.List(fields.String, required=True, allow_none=False)
     tiles = fields.List(fields.String, required=True, allow_none=False)
     start_date = fields.Date()
-    end_date = fields.Date()
\ No newline at end of file
+    end_date = fields.Date()
+    provenance = fields.Boolean(missing=False)
+    incremental = fields.Boolean(missing=False)
+    scene_batched = fields.Boolean(missing=False)
\ No newline at end of file
@@ -6,7 +6,9 @@ from celery import chain, group
 # BDC Scripts
 from bdc_db.models import Collection
 from bdc_scripts.celery import celery_app
+from .manifest import PeriodManifest
 from .utils import merge as merge_processing, \
+                   merge_scene as merge_scene_processing, \
                    blend as blend_processing, \
                    publish_datacube, publish_merge
 
@@ -18,15 +20,50 @@ def warp_merge(warped_datacube, tile_id, period, warps, cols, rows, **kwargs):
     return merge_processing(warped_datacube, tile_id, warps, int(cols), int(rows), period, **kwargs)
 
 
+@celery_app.task()
+def warp_merge_scene(warped_datacube, tile_id, period, band_assets, cols, rows, **kwargs):
+    logging.warning('Executing scene merge {} - {}'.format(kwargs.get('datacube'), kwargs.get('date')))
+
+    return merge_scene_processing(warped_datacube, tile_id, band_assets, int(cols), int(rows), period, **kwargs)
+
+
 @celery_app.task()
 def merge(warps, *args, **kwargs):
     logging.warning('Executing merge')
 
 
 @celery_app.task()
-def blend(merges):
+def blend(merges, provenance=False, incremental=False):
     activities = dict()
 
+    # Scene batched merges return a list of merges per task
+    merges = [
+        _merge
+        for result in merges
+        for _merge in (result if isinstance(result, list) else [result])
+    ]
+
+    # Windows of tile touched by the new merges of each band
+    update_windows = dict()
+
+    if merges:
+        manifest = PeriodManifest(merges[0]['warped_datacube'], merges[0]['tile_id'], merges[0]['period'])
+
+        if incremental:
+            for _merge in merges:
+                if _merge['footprint'] is not None:
+                    update_windows.setdefault(_merge['band'], []).append(_merge['footprint'])
+
+            # Reuse the merges already done for the period
+            new_merges = {(_merge['band'], _merge['date']) for _merge in merges}
+
+            merges = list(merges) + [
+                _merge for _merge in manifest.merges() if (_merge['band'], _merge['date']) not in new_merges
+            ]
+
+        manifest.update(merges)
+        manifest.save()
+
     for _merge in merges:
         if _merge['band'] in activities and _merge['date'] in activities[_merge['band']]['scenes']:
             continue
@@ -47,6 +84,16 @@ def blend(merges):
 
         activities[_merge['band']] = activity
 
+    if incremental:
+        for band, activity in activities.items():
+            activity['update_windows'] = update_windows.get(band, [])
+
+    # Provenance and clear observation count only depend on quality masks,
+    # so they are produced once, along with the quality band blend
+    if provenance and activities:
+        provenance_band = 'quality' if 'quality' in activities else next(iter(activities))
+        activities[provenance_band]['provenance'] = True
+
     logging.warning('Scheduling blend....')
 
     blends = []
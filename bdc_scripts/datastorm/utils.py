@@ -1,19 +1,48 @@
 # Python Native
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
+from functools import lru_cache
+import logging
 import os
+import threading
 import time
 # 3rdparty
-from numpngw import write_png
-from rasterio import Affine, MemoryFile
-from rasterio.warp import reproject, Resampling
+from rasterio import Affine
+from rasterio.errors import WindowError
+from rasterio.transform import array_bounds
+from rasterio.warp import transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds, intersect as window_intersect, union as window_union
 import numpy
 import rasterio
 # BDC Scripts
 from bdc_db.models import Collection
 from bdc_scripts.config import Config
+from bdc_scripts.core.mask import batch_mask_counts, decode_mask, get_mask_decoder, mask_counts, mask_statistics
+from bdc_scripts.core.quicklook import generate_quicklook
+from bdc_scripts.core.utils import generate_cogs_parallel
+from .cache import MergeCache
+from .composite import get_composite_function, get_cube_id
+from .warp import SceneWarps
+
+
+# Nodata of PROVENANCE band (uint16). Limits the number of scenes of blend to 65534
+PROVENANCE_NODATA = 65535
 
 
 def merge(warped_datacube, tile_id, assets, cols, rows, period, **kwargs):
+    """
+    Warp and merge the assets of a date into the tile grid.
+
+    The output is processed in blocks of ``block_size`` pixels (aligned to the
+    GeoTIFF tiles). For each block, every asset is reprojected and the first
+    valid pixel is kept, so the memory usage is bounded by the block size
+    instead of the tile size. Use ``block_size=0`` to process the whole tile at once.
+
+    The warped sources may be shared with other bands of the same scenes through
+    ``scene_warps`` (see :func:`merge_scene`).
+    """
     datacube = kwargs['datacube']
     nodata = kwargs.get('nodata', None)
     xmin = kwargs.get('xmin')
@@ -22,6 +51,8 @@ def merge(warped_datacube, tile_id, assets, cols, rows, period, **kwargs):
     band = assets[0]['band']
     merge_date = kwargs.get('date')
     resx, resy = kwargs.get('resx'), kwargs.get('resy')
+    block_size = kwargs.get('block_size', Config.MERGE_BLOCK_SIZE)
+    scene_warps = kwargs.get('scene_warps')
 
     formatted_date = datetime.strptime(merge_date, '%Y-%m-%d').strftime('%Y%m%d')
 
@@ -39,63 +70,40 @@ def merge(warped_datacube, tile_id, assets, cols, rows, period, **kwargs):
     else:
         resampling = Resampling.bilinear
 
-    # For all files
-    src = rasterio.open(assets[0]['link'])
-    raster = numpy.zeros((rows, cols,), dtype=src.profile['dtype'])
-    rasterMerge = numpy.zeros((rows, cols,), dtype=src.profile['dtype'])
-    rasterMask = numpy.ones((rows, cols,), dtype=src.profile['dtype'])
-    count = 0
-    template = None
-    for asset in assets:
-        count += 1
-        with rasterio.Env(CPL_CURL_VERBOSE=False):
-            with rasterio.open(asset['link']) as src:
-                kwargs = src.meta.copy()
-                kwargs.update({
-                    'crs': srs,
-                    'transform': transform,
-                    'width': cols,
-                    'height': rows
-                })
-
-                if src.profile['nodata'] is not None:
-                    nodata = src.profile['nodata']
-                elif nodata is None:
-                    nodata = 0
-
-                kwargs.update({
-                    'nodata': nodata
-                })
-
-                with MemoryFile() as mem_file:
-                    with mem_file.open(**kwargs) as dst:
-                        reproject(
-                            source=rasterio.band(src, 1),
-                            destination=raster,
-                            src_transform=src.transform,
-                            src_crs=src.crs,
-                            dst_transform=transform,
-                            dst_crs=srs,
-                            src_nodata=nodata,
-                            dst_nodata=nodata,
-                            resampling=resampling)
-                        rasterMerge = rasterMerge + raster*rasterMask
-                        rasterMask[raster != nodata] = 0
-                        if template is None:
-                            template = dst.profile
-
-    # Evaluate cloud cover and efficacy if band is quality
-    efficacy = 0
-    cloudratio = 100
-    if band == 'quality':
-        rasterMerge, efficacy, cloudratio = getMask(rasterMerge, dataset)
-        template.update({'dtype': 'uint8'})
-
     target_dir = os.path.dirname(merged_file)
     os.makedirs(target_dir, exist_ok=True)
 
-    with rasterio.open(merged_file, 'w', **template) as merge_dataset:
-        merge_dataset.write_band(1, rasterMerge)
+    # Identical merges (same assets and grid) are shared among datacubes
+    cache = MergeCache() if Config.MERGE_CACHE_MAX_SIZE else None
+
+    cache_key = MergeCache.key(
+        assets=[asset['link'] for asset in assets],
+        band=band,
+        dataset=dataset,
+        cols=cols,
+        rows=rows,
+        transform=list(transform)[:6],
+        srs=srs,
+        nodata=nodata,
+        resampling=resampling.name,
+        block_size=block_size
+    )
+
+    cached = cache.get(cache_key, merged_file) if cache else None
+
+    if cached is not None:
+        efficacy, cloudratio, footprint = cached['efficacy'], cached['cloudratio'], cached['footprint']
+    else:
+        # The merged file may be a hard link shared with cache. Unlink it instead of overwriting
+        if os.path.exists(merged_file):
+            os.remove(merged_file)
+
+        efficacy, cloudratio, footprint = _warp_merge(merged_file, assets, cols, rows, transform, srs,
+                                                      nodata, resampling, band, dataset, block_size,
+                                                      scene_warps=scene_warps)
+
+        if cache:
+            cache.put(cache_key, merged_file, dict(efficacy=efficacy, cloudratio=cloudratio, footprint=footprint))
 
     return dict(
         band=band,
@@ -108,16 +116,276 @@ def merge(warped_datacube, tile_id, assets, cols, rows, period, **kwargs):
         date='{}{}'.format(merge_date, dataset),
         datacube=datacube,
         tile_id=tile_id,
-        warped_datacube=warped_datacube
+        warped_datacube=warped_datacube,
+        assets=[asset['link'] for asset in assets],
+        footprint=footprint
     )
 
 
+def merge_scene(warped_datacube, tile_id, band_assets, cols, rows, period, **kwargs):
+    """
+    Warp and merge all bands of a scene date in a single call.
+
+    The bands are merged one after another inside the same GDAL environment, which
+    keeps the HTTP connections and VSI cache between bands. The bands of a scene
+    with the same source grid share a single warped VRT (see :class:`SceneWarps`),
+    so the source to tile transformer is built once per scene grid and tile grid
+    instead of once per band.
+
+    Args:
+        band_assets (list) - Entries with ``assets``, ``resx`` and ``resy`` of each band
+        **kwargs - Same properties of :func:`merge`
+
+    Returns:
+        list The merge result of each band, as in :func:`merge`
+    """
+    merges = []
+
+    with rasterio.Env(CPL_CURL_VERBOSE=False, VSI_CACHE=True, GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'), \
+            SceneWarps([entry['assets'] for entry in band_assets]) as scene_warps:
+        for entry in band_assets:
+            properties = dict(kwargs)
+            properties.update(resx=entry['resx'], resy=entry['resy'], scene_warps=scene_warps)
+
+            merges.append(merge(warped_datacube, tile_id, entry['assets'], cols, rows, period, **properties))
+
+    return merges
+
+
+def _warp_merge(merged_file, assets, cols, rows, transform, srs, nodata, resampling, band, dataset, block_size,
+                scene_warps=None):
+    """
+    Warp and merge the assets into merged_file, block by block.
+
+    The assets are warped through scene_warps when given, which keeps its sources
+    open for the next bands. Otherwise, the sources are closed once merged.
+
+    Returns:
+        Tuple with efficacy, cloud ratio and footprint (``[col_off, row_off, width, height]`` or None)
+    """
+    # Evaluate cloud cover and efficacy if band is quality
+    efficacy = 0
+    cloudratio = 100
+    # Number of fill, clear and cloud pixels of quality band
+    counts = numpy.zeros(3, dtype=numpy.int64)
+    # Window of tile covered by the assets
+    footprint = None
+
+    # Sources of this band only, closed once merged
+    own_warps = scene_warps is None
+    if own_warps:
+        scene_warps = SceneWarps([assets])
+
+    with rasterio.Env(CPL_CURL_VERBOSE=False):
+        warps = []
+
+        try:
+            sources = [(asset['link'], scene_warps.open(asset['link'])) for asset in assets]
+
+            if nodata is None:
+                nodata = next((src.nodata for _, src in sources if src.nodata is not None), 0)
+
+            dtype = sources[0][1].profile['dtype']
+
+            for link, src in sources:
+                # Restrict each asset to the window it covers in the tile. Assets out of tile are skipped
+                src_footprint = _footprint_window(src.crs.to_wkt(), src.transform, src.width, src.height,
+                                                  srs, transform, cols, rows)
+
+                if src_footprint is None:
+                    continue
+
+                # The warped VRT is shared by the bands of scene with same source grid: GDAL builds the
+                # source to tile transformer once and reuses it for every block read of these bands
+                vrt, index = scene_warps.warp(link, srs, transform, cols, rows, resampling, nodata)
+
+                warps.append((vrt, index, Window(*src_footprint)))
+
+            if warps:
+                footprint = window_union(*[src_footprint for _, _, src_footprint in warps])
+
+            profile = dict(
+                driver='GTiff',
+                count=1,
+                dtype='uint8' if band == 'quality' else dtype,
+                nodata=nodata,
+                crs=srs,
+                transform=transform,
+                width=cols,
+                height=rows
+            )
+
+            if block_size:
+                profile.update(dict(
+                    tiled=True,
+                    blockxsize=block_size,
+                    blockysize=block_size,
+                    compress='LZW'
+                ))
+
+            # Extra pixels warped around each block of quality band, so the mask post processing
+            # (i.e dilation and hole removal) decodes the block as the whole tile
+            halo = get_mask_decoder(dataset).halo if band == 'quality' and block_size else 0
+
+            with rasterio.open(merged_file, 'w', **profile) as merge_dataset:
+                for window in _merge_windows(cols, rows, block_size):
+                    outer = _expand_window(window, halo, cols, rows)
+
+                    raster = _merge_window(warps, outer, nodata, dtype)
+
+                    if band == 'quality':
+                        raster = decode_mask(raster, dataset)
+
+                    # Remove the halo pixels
+                    row_off = window.row_off - outer.row_off
+                    col_off = window.col_off - outer.col_off
+                    raster = raster[row_off:row_off + window.height, col_off:col_off + window.width]
+
+                    if band == 'quality':
+                        counts += mask_counts(raster)
+
+                    merge_dataset.write(raster.astype(profile['dtype'], copy=False), window=window, indexes=1)
+        finally:
+            if own_warps:
+                scene_warps.close()
+
+    if band == 'quality':
+        efficacy, cloudratio = mask_statistics(counts)
+
+    if footprint is not None:
+        footprint = [footprint.col_off, footprint.row_off, footprint.width, footprint.height]
+
+    return efficacy, cloudratio, footprint
+
+
+def _merge_windows(cols, rows, block_size):
+    """Generate the output windows of merge. A single window is used when block_size is not set."""
+    if not block_size:
+        yield Window(0, 0, cols, rows)
+        return
+
+    for row_off in range(0, rows, block_size):
+        for col_off in range(0, cols, block_size):
+            yield Window(col_off, row_off, min(block_size, cols - col_off), min(block_size, rows - row_off))
+
+
+def _expand_window(window, halo, cols, rows):
+    """Expand the window by halo pixels in each direction, limited to the tile extent."""
+    if not halo:
+        return window
+
+    col_off = max(window.col_off - halo, 0)
+    row_off = max(window.row_off - halo, 0)
+    col_end = min(window.col_off + window.width + halo, cols)
+    row_end = min(window.row_off + window.height + halo, rows)
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+@lru_cache(maxsize=256)
+def _footprint_window(src_crs, src_transform, src_width, src_height, srs, transform, cols, rows):
+    """
+    Evaluate the window of tile covered by the footprint of a source grid.
+
+    The result is cached by (source grid, tile), so the bands of a scene with same
+    resolution skip the footprint reprojection.
+
+    Returns:
+        Tuple (col_off, row_off, width, height) of the intersection of source footprint
+        and tile, or None when they are disjoint
+    """
+    src_bounds = array_bounds(src_height, src_width, src_transform)
+    # array_bounds retrieves (west, south, east, north)
+    bounds = transform_bounds(src_crs, srs, *src_bounds, densify_pts=21)
+
+    window = from_bounds(*bounds, transform=transform)
+
+    # Keep one extra pixel in order to cover the resampling kernel on the footprint border
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    window = Window(int(window.col_off) - 1, int(window.row_off) - 1, int(window.width) + 2, int(window.height) + 2)
+
+    try:
+        window = window.intersection(Window(0, 0, cols, rows))
+    except WindowError:
+        return None
+
+    return window.col_off, window.row_off, window.width, window.height
+
+
+def _merge_window(warps, window, nodata, dtype):
+    """
+    Reproject the sources into the given window of tile, keeping the first valid pixel.
+
+    Only the part of window covered by each source footprint is reprojected, and
+    the remaining sources are skipped once every pixel of window is filled.
+
+    Args:
+        warps (list) - WarpedVRT (in tile grid), band index and footprint window of each source, in merge order
+        window (Window) - Output window in tile grid
+        nodata (number) - Output nodata
+        dtype (str) - Data type of the sources
+
+    Returns:
+        numpy.ndarray The merged block
+    """
+    raster = numpy.full((window.height, window.width), nodata, dtype=dtype)
+    # Pixels not filled yet
+    todo = numpy.ones(raster.shape, dtype=numpy.bool_)
+
+    for vrt, index, footprint in warps:
+        try:
+            area = window.intersection(footprint)
+        except WindowError:
+            continue
+
+        warped = vrt.read(index, window=area)
+
+        # Position of the warped area inside block
+        rows = slice(area.row_off - window.row_off, area.row_off - window.row_off + area.height)
+        cols = slice(area.col_off - window.col_off, area.col_off - window.col_off + area.width)
+
+        valid = warped != nodata
+        fill = todo[rows, cols] & valid
+        raster[rows, cols][fill] = warped[fill]
+        todo[rows, cols] &= ~valid
+
+        if not todo.any():
+            break
+
+    return raster
+
+
 def blend(activity):
+    """
+    Generate the temporal composites of a band from the merged scenes of a period.
+
+    The blocks of all scenes are read together and every composite function
+    listed in ``activity['composite_functions']`` (default MEDIAN and STACK) is
+    evaluated from the same read. The blocks are distributed over a thread pool,
+    since GDAL releases the GIL during I/O. Each composite is written block by
+    block into a tiled GeoTIFF, which is then converted to Cloud Optimized GeoTIFF
+    (see :func:`bdc_scripts.core.utils.generate_cogs`).
+
+    When ``activity['provenance']`` is set, it also writes the PROVENANCE band
+    (index of the scene, in efficacy order, which filled the STACK pixel) and the
+    CNC band (count of clear observations). The scene order is stored in
+    ``activity['provenance_scenes']`` and in the PROVENANCE file tags.
+
+    When ``activity['update_windows']`` is set (incremental mode) and the
+    composites already exist, only the blocks intersecting these windows
+    (``[col_off, row_off, width, height]`` of the new merges) are re-blended in place.
+    Provenance always requires the full blend, since the scene indices change.
+    """
     # Assume that it contains a band and quality band
     numscenes = len(activity['scenes'])
 
     band = activity['band']
 
+    composite_functions = {
+        name.upper(): get_composite_function(name)
+        for name in activity.get('composite_functions', ['MEDIAN', 'STACK'])
+    }
+
     # Get basic information (profile) of input files
     keys = list(activity['scenes'].keys())
 
@@ -125,7 +393,6 @@ def blend(activity):
 
     with rasterio.open(filename) as src:
         profile = src.profile
-        tilelist = list(src.block_windows())
 
     # Order scenes based in efficacy/resolution
     mask_tuples = []
@@ -136,114 +403,242 @@ def blend(activity):
         resolution = int(scene['resolution'])
         mask_tuples.append((100. * efficacy / resolution, key))
 
-    # Open all input files and save the datasets in two lists, one for masks and other for the current band.
-    # The list will be ordered by efficacy/resolution
-    masklist = []
-    bandlist = []
+    # Pairs of (mask, band) files ordered by efficacy/resolution
+    files = []
+    scene_keys = []
     for m in sorted(mask_tuples, reverse=True):
         key = m[1]
-        efficacy = m[0]
         scene = activity['scenes'][key]
 
-        filename = scene['ARDfiles']['quality']
-        try:
-            masklist.append(rasterio.open(filename))
-        except BaseException as e:
-            raise IOError('FileError while opening {} - {}'.format(filename, e))
+        files.append((scene['ARDfiles']['quality'], scene['ARDfiles'][band]))
+        scene_keys.append(key)
 
-        filename = scene['ARDfiles'][band]
+    provenance = activity.get('provenance', False)
 
-        try:
-            bandlist.append(rasterio.open(filename))
-        except BaseException as e:
-            raise IOError('FileError while opening {} - {}'.format(filename, e))
+    if provenance and numscenes >= PROVENANCE_NODATA:
+        logging.warning('Skipping provenance of {} - too many scenes ({})'.format(band, numscenes))
+        provenance = False
 
     # Build the raster to store the output images.
     width = profile['width']
     height = profile['height']
+    nodata = profile.get('nodata') or 0
+    block_size = Config.MERGE_BLOCK_SIZE or 512
 
-    # STACK will be generated in memory
-    stackRaster = numpy.zeros((height, width), dtype=profile['dtype'])
+    profile.update(dict(
+        driver='GTiff',
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress='LZW'
+    ))
 
     datacube = activity.get('datacube')
     period = activity.get('period')
     tile_id = activity.get('tile_id')
-    output_name = '{}-{}-{}-{}.tif'.format(datacube, tile_id, period, band)
-    #
-    # MEDIAN will be generated in local disk
-    medianfile = os.path.join(Config.DATA_DIR, 'Repository/collections/cubes/{}/{}/{}/{}'.format(
-        datacube, tile_id, period, output_name))
-
-    os.makedirs(os.path.dirname(medianfile), exist_ok=True)
-
-    mediandataset = rasterio.open(medianfile, 'w', **profile)
-    count = 0
-    for _, window in tilelist:
-        # Build the stack to store all images as a masked array. At this stage the array will contain the masked data
-        stackMA = numpy.ma.zeros((numscenes, window.height, window.width), dtype=numpy.uint16)
-
-        # notdonemask will keep track of pixels that have not been filled in each step
-        notdonemask = numpy.ones(shape=(window.height, window.width), dtype=numpy.bool_)
-
-        # For all pair (quality,band) scenes
-        for order in range(numscenes):
-            ssrc = bandlist[order]
-            msrc = masklist[order]
-            raster = ssrc.read(1,window=window)
-            mask = msrc.read(1,window=window)
-            mask[mask != 1] = 0
-            bmask = mask.astype(numpy.bool_)
-
-            # Use the mask to mark the fill (0) and cloudy (2) pixels
-            stackMA[order] = numpy.ma.masked_where(numpy.invert(bmask), raster)
-
-            # Evaluate the STACK image
-            # Pixels that have been already been filled by previous rasters will be masked in the current raster
-            todomask = notdonemask * bmask
-            notdonemask = notdonemask * numpy.invert(bmask)
-            stackRaster[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width] += (raster * todomask).astype(profile['dtype'])
-
-        medianRaster = numpy.ma.median(stackMA,axis=0).data
-        mediandataset.write(medianRaster.astype(profile['dtype']), window=window, indexes=1)
-        count += 1
-
-    # Close all input dataset
-    for order in range(numscenes):
-        bandlist[order].close()
-        masklist[order].close()
+
+    blends = dict()
+    datasets = dict()
+
+    for name in composite_functions:
+        cube_id = get_cube_id(datacube, name)
+        output_name = '{}-{}-{}-{}.tif'.format(cube_id, tile_id, period, band)
+
+        blends[name] = os.path.join(Config.DATA_DIR, 'Repository/collections/cubes/{}/{}/{}/{}'.format(
+            cube_id, tile_id, period, output_name))
+
+    update_windows = activity.get('update_windows')
+
+    incremental = update_windows is not None and not provenance and \
+        all(os.path.exists(blend_file) for blend_file in blends.values())
+
+    if incremental:
+        update_windows = [Window(*update_window) for update_window in update_windows]
+
+    for name, blend_file in blends.items():
+        if incremental:
+            datasets[name] = rasterio.open(blend_file, 'r+')
+            continue
+
+        os.makedirs(os.path.dirname(blend_file), exist_ok=True)
+
+        datasets[name] = rasterio.open(blend_file, 'w', **profile)
+
+    observations = dict()
+    observation_datasets = dict()
+
+    if provenance:
+        for name, nodata_value in [('PROVENANCE', PROVENANCE_NODATA), ('CNC', None)]:
+            output_name = '{}-{}-{}-{}.tif'.format(datacube, tile_id, period, name)
+
+            observations[name] = os.path.join(Config.DATA_DIR, 'Repository/collections/cubes/{}/{}/{}/{}'.format(
+                datacube, tile_id, period, output_name))
+
+            os.makedirs(os.path.dirname(observations[name]), exist_ok=True)
+
+            observation_profile = profile.copy()
+            observation_profile.update(dict(dtype='uint16', nodata=nodata_value))
+
+            observation_datasets[name] = rasterio.open(observations[name], 'w', **observation_profile)
+
+        observation_datasets['PROVENANCE'].update_tags(scenes=','.join(scene_keys))
+
+    # Each thread keeps its own handlers, since rasterio datasets can not be shared among threads
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def _open_scenes():
+        if not hasattr(local, 'scenes'):
+            # Close the files already opened by this thread when any other fails
+            with ExitStack() as stack:
+                scenes = [
+                    (stack.enter_context(_open_dataset(mask_file)), stack.enter_context(_open_dataset(band_file)))
+                    for mask_file, band_file in files
+                ]
+
+                stack.pop_all()
+
+            local.scenes = scenes
+
+            with opened_lock:
+                opened.extend(local.scenes)
+
+        return local.scenes
+
+    def _blend_block(window):
+        # Stack of all scenes as float, where the fill (0) and cloudy (2) pixels are NaN
+        stack = numpy.full((numscenes, window.height, window.width), numpy.nan, dtype=numpy.float32)
+
+        scenes = _open_scenes()
+        masks = numpy.stack([msrc.read(1, window=window) for msrc, _ in scenes])
+
+        # Clear pixels of each scene in block. Scenes without any are not read
+        clear_counts = batch_mask_counts(masks)[:, 1]
+
+        for order, (_, ssrc) in enumerate(scenes):
+            if not clear_counts[order]:
+                continue
+
+            raster = ssrc.read(1, window=window)
+
+            clear = masks[order] == 1
+            stack[order][clear] = raster[clear]
+
+        composites = {name: function(stack) for name, function in composite_functions.items()}
+
+        clear_count = numpy.count_nonzero(~numpy.isnan(stack), axis=0).astype(numpy.uint16)
+
+        # Number of pixels without any clear observation
+        notdone = numpy.count_nonzero(clear_count == 0)
+
+        block_observations = dict()
+
+        if provenance:
+            # Index of the first clear scene, the same used by STACK
+            block_provenance = numpy.argmax(~numpy.isnan(stack), axis=0).astype(numpy.uint16)
+            block_provenance[clear_count == 0] = PROVENANCE_NODATA
+
+            block_observations['PROVENANCE'] = block_provenance
+            block_observations['CNC'] = clear_count
+
+        return window, composites, block_observations, notdone
+
+    notdonepix = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=Config.BLEND_THREADS) as executor:
+            any_dataset = next(iter(datasets.values()))
+            windows = (window for _, window in any_dataset.block_windows(1))
+
+            if incremental:
+                windows = (
+                    window for window in windows
+                    if any(window_intersect(window, update_window) for update_window in update_windows)
+                )
+
+            results = _bounded_map(executor, _blend_block, windows, 2 * Config.BLEND_THREADS)
+
+            for window, composites, block_observations, notdone in results:
+                for name, raster in composites.items():
+                    raster = numpy.nan_to_num(raster, nan=nodata)
+                    datasets[name].write(raster.astype(profile['dtype']), window=window, indexes=1)
+
+                for name, raster in block_observations.items():
+                    observation_datasets[name].write(raster, window=window, indexes=1)
+
+                notdonepix += notdone
+    finally:
+        # Close all input and output datasets
+        for msrc, ssrc in opened:
+            msrc.close()
+            ssrc.close()
+
+        for dataset in list(datasets.values()) + list(observation_datasets.values()):
+            dataset.close()
+
+    # Move the overviews ahead of data (COG layout). Composites and provenance are not
+    # interpolated, so the overviews keep the values of the blend
+    conversions = [
+        dict(input_data_set_path=file_path, file_path=file_path, resampling='NEAREST', block_size=block_size)
+        for file_path in list(blends.values()) + list(observations.values())
+    ]
+
+    for conversion, _ in generate_cogs_parallel(conversions):
+        logging.info('COG {} done'.format(conversion['file_path']))
 
     # Evaluate cloudcover
-    cloudcover = 100. * ((height * width - numpy.count_nonzero(stackRaster)) / (height * width))
-    #
-    # # Close and upload the MEDIAN dataset
-    mediandataset.close()
-    mediandataset = None
-    # key = activity['MEDIANfile']
-
-    # Create and upload the STACK dataset
-    # with MemoryFile() as memfile:
-    #     with memfile.open(**profile) as dataset:
-    #         dataset.write_band(1,stackRaster)
-    #         if self.verbose > 2: print ('blend - STACK profile',dataset.profile)
-
-    #     key = activity['STACKfile']
-    #     if self.verbose > 1: print('blend - key STACKfile',key)
-    #     self.S3client.upload_fileobj(memfile, Bucket=self.bucket_name, Key=key, ExtraArgs={'ACL': 'public-read'})
+    cloudcover = 100. * (notdonepix / (height * width))
 
     activity['efficacy'] = 0
     activity['cloudratio'] = 100
-    activity['blends'] = {"MEDIAN": medianfile}
+    activity['blends'] = blends
+
+    if provenance:
+        activity['observations'] = observations
+        activity['provenance_scenes'] = scene_keys
 
     return activity
 
 
+def _open_dataset(file):
+    """Open a raster file, naming the file when it fails."""
+    try:
+        return rasterio.open(file)
+    except Exception as e:
+        raise IOError('FileError while opening {} - {}'.format(file, e))
+
+
+def _bounded_map(executor, function, items, limit):
+    """
+    Map items over executor keeping at most limit tasks pending.
+
+    It yields the results in the same order of items, so the blocks already
+    processed do not pile up in memory while they wait to be written.
+    """
+    pending = deque()
+
+    for item in items:
+        pending.append(executor.submit(function, item))
+
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
 def publish_datacube(bands, datacube, tile_id, period, scenes):
-    for composite_function in ['MEDIAN']:  # ,'STACK']:
-        quick_look_name = '{}-{}-{}_{}'.format(datacube, tile_id, period, composite_function)
+    # Generate a quick look for each composite function produced by blend
+    composite_functions = scenes[bands[0]].keys()
+
+    for composite_function in composite_functions:
+        cube_id = get_cube_id(datacube, composite_function)
+        quick_look_name = '{}-{}-{}_{}'.format(cube_id, tile_id, period, composite_function)
         quick_look_file = os.path.join(
             Config.DATA_DIR,
             'Repository/collections/cubes/{}/{}/{}/{}'.format(
-                datacube, tile_id, period, quick_look_name
+                cube_id, tile_id, period, quick_look_name
             )
         )
 
@@ -270,125 +665,30 @@ def publish_merge(bands, datacube, dataset, tile_id, period, date, scenes):
     generate_quick_look(quick_look_file, ql_files)
 
 
-def generate_quick_look(file_path, qlfiles):
-    with rasterio.open(qlfiles[0]) as src:
-        profile = src.profile
+def generate_quick_look(file_path, qlfiles, tiles=None):
+    """
+    Generate the quick look ``<file_path>.png`` of a merge or composite.
 
-    numlin = 768
-    numcol = int(float(profile['width'])/float(profile['height'])*numlin)
-    image = numpy.ones((numlin,numcol,len(qlfiles),), dtype=numpy.uint8)
-    pngname = '{}.png'.format(file_path)
+    Args:
+        file_path (str) - Path to the quick look without extension
+        qlfiles (list) - Path to the red, green and blue files
+        tiles (bool) - Write a tile pyramid in ``<file_path>_tiles``. Default is Config.QUICK_LOOK_PYRAMID
 
-    nb = 0
-    for file in qlfiles:
-        with rasterio.open(file) as src:
-            raster = src.read(1, out_shape=(numlin, numcol))
+    Returns:
+        Path to the PNG file
+    """
+    if tiles is None:
+        tiles = Config.QUICK_LOOK_PYRAMID
 
-            # Rescale to 0-255 values
-            nodata = raster <= 0
-            if raster.min() != 0 or raster.max() != 0:
-                raster = raster.astype(numpy.float32)/10000.*255.
-                raster[raster > 255] = 255
-            image[:, :, nb] = raster.astype(numpy.uint8) * numpy.invert(nodata)
-            nb += 1
+    tiles_dir = '{}_tiles'.format(file_path) if tiles else None
 
-    write_png(pngname, image, transparent=(0, 0, 0))
-    return pngname
+    return generate_quicklook('{}.png'.format(file_path), qlfiles, stretch='scale',
+                              resampling=Resampling.nearest, tiles_dir=tiles_dir)
 
 
 def getMask(raster, dataset):
-    from skimage import morphology
-    # Output Cloud Mask codes
-    # 0 - fill
-    # 1 - clear data
-    # 0 - cloud
-    if dataset == 'LC8SR':
-        # Input pixel_qa codes
-        fill    = 1 				# warped images have 0 as fill area
-        terrain = 2					# 0000 0000 0000 0010
-        radsat  = 4+8				# 0000 0000 0000 1100
-        cloud   = 16+32+64			# 0000 0000 0110 0000
-        shadow  = 128+256			# 0000 0001 1000 0000
-        snowice = 512+1024			# 0000 0110 0000 0000
-        cirrus  = 2048+4096			# 0001 1000 0000 0000
-
-        unique, counts = numpy.unique(raster, return_counts=True)
-
-        # Start with a zeroed image imagearea
-        imagearea = numpy.zeros(raster.shape, dtype=numpy.bool_)
-        # Mark with True the pixels that contain valid data
-        imagearea = imagearea + raster > fill
-        # Create a notcleararea mask with True where the quality criteria is as follows
-        notcleararea = 	(raster & radsat > 4) + \
-                    (raster & cloud > 64) + \
-                    (raster & shadow > 256) + \
-                    (raster & snowice > 512) + \
-                    (raster & cirrus > 4096)
-
-        strel = morphology.selem.square(6)
-        notcleararea = morphology.binary_dilation(notcleararea,strel)
-        morphology.remove_small_holes(notcleararea, area_threshold=80, connectivity=1, in_place=True)
-
-        # Clear area is the area with valid data and with no Cloud or Snow
-        cleararea = imagearea * numpy.invert(notcleararea)
-        # Code the output image rastercm as the output codes
-        rastercm = (2*notcleararea + cleararea).astype(numpy.uint8)
-
-    elif dataset == 'MOD13Q1' or dataset == 'MYD13Q1':
-        # MOD13Q1 Pixel Reliability !!!!!!!!!!!!!!!!!!!!
-        # Note that 1 was added to this image in downloadModis because of warping
-        # Rank/Key Summary QA 		Description
-        # -1 		Fill/No Data 	Not Processed
-        # 0 		Good Data 		Use with confidence
-        # 1 		Marginal data 	Useful, but look at other QA information
-        # 2 		Snow/Ice 		Target covered with snow/ice
-        # 3 		Cloudy 			Target not visible, covered with cloud
-        fill    = 0 	# warped images have 0 as fill area
-        lut = numpy.array([0,1,1,2,2],dtype=numpy.uint8)
-        rastercm = numpy.take(lut,raster+1).astype(numpy.uint8)
-
-    elif dataset == 'S2SR_SEN28':
-        # S2 sen2cor - The generated classification map is specified as follows:
-        # Label Classification
-        #  0		NO_DATA
-        #  1		SATURATED_OR_DEFECTIVE
-        #  2		DARK_AREA_PIXELS
-        #  3		CLOUD_SHADOWS
-        #  4		VEGETATION
-        #  5		NOT_VEGETATED
-        #  6		WATER
-        #  7		UNCLASSIFIED
-        #  8		CLOUD_MEDIUM_PROBABILITY
-        #  9		CLOUD_HIGH_PROBABILITY
-        # 10		THIN_CIRRUS
-        # 11		SNOW
-        # 0 1 2 3 4 5 6 7 8 9 10 11
-        lut = numpy.array([0,0,2,2,1,1,1,2,2,2,1, 1],dtype=numpy.uint8)
-        rastercm = numpy.take(lut,raster).astype(numpy.uint8)
-
-    elif dataset == 'CB4_AWFI' or dataset == 'CB4_MUX':
-        # Key 		Summary QA 		Description
-        # 0 		Fill/No Data 	Not Processed
-        # 127 		Good Data 		Use with confidence
-        # 255 		Cloudy 			Target not visible, covered with cloud
-        fill = 0 		# warped images have 0 as fill area
-        lut = numpy.zeros(256,dtype=numpy.uint8)
-        lut[127] = 1
-        lut[255] = 2
-        rastercm = numpy.take(lut,raster).astype(numpy.uint8)
-
-    unique, counts = numpy.unique(rastercm, return_counts=True)
-
-    totpix   = rastercm.size
-    fillpix  = numpy.count_nonzero(rastercm==0)
-    clearpix = numpy.count_nonzero(rastercm==1)
-    cloudpix = numpy.count_nonzero(rastercm==2)
-    imagearea = clearpix+cloudpix
-    clearratio = 0
-    cloudratio = 100
-    if imagearea != 0:
-        clearratio = round(100.*clearpix/imagearea,1)
-        cloudratio = round(100.*cloudpix/imagearea,1)
-    efficacy = round(100.*clearpix/totpix,2)
+    rastercm = decode_mask(raster, dataset)
+
+    efficacy, cloudratio = mask_statistics(mask_counts(rastercm))
 
-    return rastercm,efficacy,cloudratio
+    return rastercm, efficacy, cloudratio
@@ -0,0 +1,160 @@
+"""
+Defines the warped sources shared by the bands of a scene.
+
+Every band of a scene is a separate file, although the bands of same resolution
+share one source grid. Instead of one warped VRT per band file, the files of a
+scene with same grid, data type and nodata are stacked in a VRT with one band per
+file, and a single warped VRT of the stack reprojects all of them into the tile.
+GDAL then builds the source to tile transformer once per (scene grid, tile grid)
+and each band is read by its index.
+"""
+
+# Python Native
+from xml.etree import ElementTree
+# 3rdparty
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.io import MemoryFile
+from rasterio.vrt import WarpedVRT
+import rasterio
+
+
+class SceneWarps:
+    """
+    Warped VRTs of the assets of a merge, shared among bands.
+
+    Assets are grouped by ``sceneid`` (or by link, when not set). Sources are
+    opened on first use and kept open until :meth:`close`.
+
+    Example:
+        >>> with SceneWarps([red_assets, nir_assets]) as warps:
+        >>>     vrt, index = warps.warp(red_assets[0]['link'], srs, transform, cols, rows, resampling, nodata)
+        >>>     raster = vrt.read(index, window=window)
+    """
+    def __init__(self, band_assets):
+        """
+        Args:
+            band_assets (list) - Assets of each band. Each asset is a dict with ``link`` and optionally ``sceneid``
+        """
+        # Links of each scene, in band order
+        self._scenes = dict()
+        # Scene of each link
+        self._scene_of = dict()
+
+        for assets in band_assets:
+            for asset in assets:
+                scene = asset.get('sceneid', asset['link'])
+
+                self._scenes.setdefault(scene, [])
+                if asset['link'] not in self._scenes[scene]:
+                    self._scenes[scene].append(asset['link'])
+
+                self._scene_of[asset['link']] = scene
+
+        self._sources = dict()
+        self._warps = dict()
+        # Datasets and memory files to close, in opening order
+        self._resources = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self, link: str):
+        """Open the source dataset of link. The dataset is shared, so it must not be closed by caller."""
+        if link not in self._sources:
+            self._sources[link] = rasterio.open(link)
+
+        return self._sources[link]
+
+    def warp(self, link: str, srs, transform, cols: int, rows: int, resampling, nodata):
+        """
+        Retrieve the warped VRT of link in the tile grid.
+
+        Args:
+            link (str) - Asset link
+            srs (str) - Tile projection
+            transform (Affine) - Tile transform
+            cols (int) - Tile width
+            rows (int) - Tile height
+            resampling (Resampling) - Resampling method
+            nodata (number) - Nodata of warped VRT, also used as source nodata when the source has none
+
+        Returns:
+            Tuple with the WarpedVRT and the index of band of link
+        """
+        grid = (srs, tuple(transform)[:6], cols, rows, resampling, nodata)
+
+        if (link, grid) not in self._warps:
+            group = self._group(link)
+            src = self.open(link)
+
+            # A single file is warped as is
+            stack = src if len(group) == 1 else self._stack(group)
+
+            vrt = WarpedVRT(stack,
+                            crs=srs,
+                            transform=transform,
+                            width=cols,
+                            height=rows,
+                            resampling=resampling,
+                            src_nodata=src.nodata if src.nodata is not None else nodata,
+                            nodata=nodata)
+            self._resources.append(vrt)
+
+            for index, member in enumerate(group, start=1):
+                self._warps[(member, grid)] = vrt, index
+
+        return self._warps[(link, grid)]
+
+    def close(self):
+        """Close the warped VRTs, stacks and sources."""
+        for resource in reversed(self._resources):
+            resource.close()
+
+        for src in self._sources.values():
+            src.close()
+
+        self._resources = []
+        self._sources = dict()
+        self._warps = dict()
+
+    def _group(self, link: str):
+        """Links of the scene of link with the same source grid, data type and nodata."""
+        def _key(src):
+            return src.crs, tuple(src.transform)[:6], src.width, src.height, src.dtypes[0], src.nodata
+
+        key = _key(self.open(link))
+
+        return [member for member in self._scenes[self._scene_of[link]] if _key(self.open(member)) == key]
+
+    def _stack(self, links):
+        """Open a VRT with one band per file of links."""
+        first = self.open(links[0])
+
+        root = ElementTree.Element('VRTDataset', rasterXSize=str(first.width), rasterYSize=str(first.height))
+        ElementTree.SubElement(root, 'SRS').text = first.crs.to_wkt()
+        ElementTree.SubElement(root, 'GeoTransform').text = ', '.join(repr(value) for value in first.transform.to_gdal())
+
+        data_type = typename_fwd[dtype_rev[first.dtypes[0]]]
+
+        for index, link in enumerate(links, start=1):
+            src = self.open(link)
+
+            band = ElementTree.SubElement(root, 'VRTRasterBand', dataType=data_type, band=str(index))
+
+            if src.nodata is not None:
+                ElementTree.SubElement(band, 'NoDataValue').text = repr(src.nodata)
+
+            source = ElementTree.SubElement(band, 'SimpleSource')
+            ElementTree.SubElement(source, 'SourceFilename', relativeToVRT='0').text = src.files[0]
+            ElementTree.SubElement(source, 'SourceBand').text = '1'
+
+        memory_file = MemoryFile(ElementTree.tostring(root), ext='vrt')
+        self._resources.append(memory_file)
+
+        stack = memory_file.open()
+        self._resources.append(stack)
+
+        return stack
@@ -7,19 +7,17 @@ import logging
 
 # 3rdparty
 from gdal import GA_ReadOnly, Open as GDALOpen
-from numpngw import write_png
-from skimage import exposure
-from skimage.transform import resize
-import numpy
 
 # BDC Scripts
 from bdc_db.models import Asset, Band, Collection, CollectionItem, CollectionTile, db
 from bdc_scripts.config import Config
-from bdc_scripts.db import add_instance, commit, db_aws
+from bdc_scripts.db import add_instance, commit
+from bdc_scripts.core.quicklook import generate_quicklook
 from bdc_scripts.core.utils import generate_evi_ndvi, generate_cogs
 from bdc_scripts.radcor.forms import CollectionItemForm
-from bdc_scripts.radcor.utils import get_or_create_model
-from bdc_scripts.radcor.models import RadcorActivity
+from bdc_scripts.radcor.manifest import ProductManifest
+from bdc_scripts.radcor.utils import ASSET_KEYS, bulk_get_or_create
+from bdc_scripts.radcor.models import RadcorActivity, ReplicationOutbox
 
 
 # Get the product files
@@ -55,7 +53,7 @@ BAND_MAP_DN = {
 DEFAULT_QUICK_LOOK_BANDS = ["swir2", "nir", "red"]
 
 
-def generate_vi(productdir, files):
+def generate_vi(productdir, files, manifest=None, sources=None):
     fragments = Path(files['red']).stem.split('_')
     pattern = "_".join(fragments[:-1])
 
@@ -64,6 +62,10 @@ def generate_vi(productdir, files):
     files['ndvi'] = ndvi_name
     files['evi'] = evi_name
 
+    if manifest is not None and all(manifest.is_up_to_date(f, sources=sources) for f in [ndvi_name, evi_name]):
+        logging.info('Vegetation indices of {} are up to date. Skipping'.format(pattern))
+        return
+
     generate_evi_ndvi(files['red'], files['nir'], files['blue'], evi_name, ndvi_name)
 
 
@@ -85,7 +87,11 @@ def publish(collection_item: CollectionItem, scene: RadcorActivity):
         target_dir = Path(Config.DATA_DIR) / 'Repository/Archive/{}/{}/{}'.format(collection_item.collection_id, yyyymm, pathrow)
         makedirs(target_dir, exist_ok=True)
 
-        productdir = uncompress(productdir, str(target_dir))
+        # Extracting again would replace the files already published
+        if ProductManifest(str(target_dir)).is_complete():
+            productdir = str(target_dir)
+        else:
+            productdir = uncompress(productdir, str(target_dir))
 
     collection = Collection.query().filter(Collection.id == collection_item.collection_id).one()
     quicklook = collection.bands_quicklook.split(',') if collection.bands_quicklook else DEFAULT_QUICK_LOOK_BANDS
@@ -112,43 +118,57 @@ def publish(collection_item: CollectionItem, scene: RadcorActivity):
 
     # Skip EVI/NDVI generation for Surface Reflectance
     # since the espa-science already done
+    # Files published previously for this scene
+    manifest = ProductManifest(productdir)
+
+    # Vegetation indices are checked against the bands they come from
+    vi_sources = [files[band] for band in ('red', 'nir', 'blue') if band in files]
+
     if collection.id == 'LC8DN':
-        generate_vi(productdir, files)
+        generate_vi(productdir, files, manifest=manifest, sources=vi_sources)
 
     # Cog files
     for band, file_path in files.items():
+        sources = vi_sources if band in ('ndvi', 'evi') else None
+
+        if manifest.is_up_to_date(file_path, sources=sources):
+            logging.info('COG {} is up to date. Skipping'.format(file_path))
+            continue
+
         # Set destination of COG file
-        files[band] = generate_cogs(file_path, file_path)
+        # Quality band values are bit flags, so its overviews must not be interpolated
+        resampling = 'NEAREST' if band == 'quality' else None
+
+        files[band] = generate_cogs(file_path, file_path, resampling=resampling)
+
+        manifest.record(file_path, sources=sources)
+        manifest.save()
 
     # Extract basic scene information and build the quicklook
     pngname = productdir+'/{}.png'.format(identifier)
+    ql_sources = [qlfiles[band] for band in quicklook]
 
-    dataset = GDALOpen(qlfiles['nir'], GA_ReadOnly)
-    numlin = 768
-    numcol = int(float(dataset.RasterXSize)/float(dataset.RasterYSize)*numlin)
-    image = numpy.zeros((numlin, numcol, len(qlfiles),), dtype=numpy.uint8)
+    if not manifest.is_up_to_date(pngname, sources=ql_sources):
+        generate_quicklook(pngname, ql_sources, stretch='percentile', nodata=-9999)
 
-    del dataset
+        manifest.record(pngname, sources=ql_sources)
+        manifest.save()
 
-    nb = 0
-    for band in quicklook:
-        template = qlfiles[band]
-        dataset = GDALOpen(template, GA_ReadOnly)
-        raster = dataset.GetRasterBand(1).ReadAsArray(0, 0, dataset.RasterXSize, dataset.RasterYSize)
+    # Raster and chunk sizes of each file, shared by both catalogs
+    raster_sizes = {}
 
-        del dataset
-
-        raster = resize(raster,(numlin,numcol), order=1, preserve_range=True)
-        nodata = raster == -9999
-        # Evaluate minimum and maximum values
-        a = numpy.array(raster.flatten())
-        p1, p99 = numpy.percentile(a[a>0], (1, 99))
-        # Convert minimum and maximum values to 1,255 - 0 is nodata
-        raster = exposure.rescale_intensity(raster, in_range=(p1, p99),out_range=(1, 255)).astype(numpy.uint8)
-        image[:, :, nb] = raster.astype(numpy.uint8) * numpy.invert(nodata)
-        nb += 1
+    for band, file_path in files.items():
+        dataset = GDALOpen(file_path, GA_ReadOnly)
+        chunk_x, chunk_y = dataset.GetRasterBand(1).GetBlockSize()
+
+        raster_sizes[band] = dict(
+            raster_size_x=dataset.RasterXSize,
+            raster_size_y=dataset.RasterYSize,
+            chunk_size_x=chunk_x,
+            chunk_size_y=chunk_y
+        )
 
-    write_png(pngname, image, transparent=(0, 0, 0))
+        del dataset
 
     productdir = productdir.replace(Config.DATA_DIR, '')
 
@@ -159,85 +179,84 @@ def publish(collection_item: CollectionItem, scene: RadcorActivity):
         )
     }
 
-    for instance in ['local', 'aws']:
-        engine_instance = {
-            'local': db,
-            'aws': db_aws
-        }
-        engine = engine_instance[instance]
+    # Skip catalog on aws for digital number
+    replicate = collection_item.collection_id != 'LC8DN'
+    aws_url = productdir.replace('/Repository/Archive', Config.AWS_BUCKET_NAME)
 
-        # Skip catalog on aws for digital number
-        if collection_item.collection_id == 'LC8DN' and instance == 'aws':
-            continue
+    quicklook_url = resource_path.join(productdir, Path(pngname).name)
 
-        if instance == 'aws':
-            asset_url = productdir.replace('/Repository/Archive', Config.AWS_BUCKET_NAME)
-        else:
-            asset_url = productdir
+    assets_to_upload['quicklook']['asset'] = quicklook_url
 
-        pngname = resource_path.join(asset_url, Path(pngname).name)
+    with db.session.begin_nested():
+        with db.session.no_autoflush:
+            # Add collection item to the session if not present
+            if collection_item not in db.session:
+                item = db.session.query(CollectionItem).filter(CollectionItem.id == collection_item.id).first()
 
-        assets_to_upload['quicklook']['asset'] = pngname
+                if not item:
+                    cloned_properties = CollectionItemForm().dump(collection_item)
+                    collection_item = CollectionItem(**cloned_properties)
+                    db.session.add(collection_item)
 
-        with engine.session.begin_nested():
-            with engine.session.no_autoflush:
-                # Add collection item to the session if not present
-                if collection_item not in engine.session:
-                    item = engine.session.query(CollectionItem).filter(CollectionItem.id == collection_item.id).first()
+            collection_item.quicklook = quicklook_url
 
-                    if not item:
-                        cloned_properties = CollectionItemForm().dump(collection_item)
-                        collection_item = CollectionItem(**cloned_properties)
-                        engine.session.add(collection_item)
+            collection_bands = db.session.query(Band).filter(Band.collection_id == collection_item.collection_id).all()
 
-                collection_item.quicklook = pngname
+            rows = []
+            registered_bands = []
 
-                collection_bands = engine.session.query(Band).filter(Band.collection_id == collection_item.collection_id).all()
+            # Inserting data into Product table at once
+            for band in files:
+                template = resource_path.join(productdir, Path(files[band]).name)
 
-                # Inserting data into Product table
-                for band in files:
-                    template = resource_path.join(asset_url, Path(files[band]).name)
+                band_model = next(filter(lambda b: band == b.common_name, collection_bands), None)
 
-                    dataset = GDALOpen(files[band], GA_ReadOnly)
-                    asset_band = dataset.GetRasterBand(1)
+                if not band_model:
+                    logging.warning('Band {} of collection {} not found in database. Skipping...'.format(
+                        band, collection_item.collection_id))
+                    continue
 
-                    chunk_x, chunk_y = asset_band.GetBlockSize()
+                rows.append(dict(
+                    collection_id=scene.collection_id,
+                    band_id=band_model.id,
+                    grs_schema_id=scene.collection.grs_schema_id,
+                    tile_id=collection_item.tile_id,
+                    collection_item_id=collection_item.id,
+                    url=template,
+                    source=cc[0],
+                    raster_size_t=1,
+                    chunk_size_t=1,
+                    **raster_sizes[band]
+                ))
+                registered_bands.append(band)
 
-                    band_model = next(filter(lambda b: band == b.common_name, collection_bands), None)
+            assets = bulk_get_or_create(Asset, rows, ASSET_KEYS, engine=db)
 
-                    if not band_model:
-                        logging.warning('Band {} of collection {} not found in database. Skipping...'.format(
-                            band, collection_item.collection_id))
-                        continue
+            for band, asset in zip(registered_bands, assets):
+                assets_to_upload[band] = dict(file=files[band], asset=asset.url)
 
-                    defaults = dict(
-                        url=template,
-                        source=cc[0],
-                        raster_size_x=dataset.RasterXSize,
-                        raster_size_y=dataset.RasterYSize,
-                        raster_size_t=1,
-                        chunk_size_t=1,
-                        chunk_size_x=chunk_x,
-                        chunk_size_y=chunk_y
-                    )
+            # The AWS catalog is written by replicate_catalog
+            if replicate:
+                aws_quicklook_url = resource_path.join(aws_url, Path(pngname).name)
+                assets_to_upload['quicklook']['asset'] = aws_quicklook_url
 
-                    asset, _ = get_or_create_model(
-                        Asset,
-                        engine=engine,
-                        defaults=defaults,
-                        collection_id=scene.collection_id,
-                        band_id=band_model.id,
-                        grs_schema_id=scene.collection.grs_schema_id,
-                        tile_id=collection_item.tile_id,
-                        collection_item_id=collection_item.id,
+                outbox = [
+                    ReplicationOutbox.collection_item(
+                        dict(CollectionItemForm().dump(collection_item), quicklook=aws_quicklook_url)
                     )
+                ]
+
+                for band, row in zip(registered_bands, rows):
+                    data = {key: value for key, value in row.items() if key != 'band_id'}
+                    data['url'] = resource_path.join(aws_url, Path(files[band]).name)
+
+                    outbox.append(ReplicationOutbox.asset(data, band=dict(common_name=band)))
 
-                    assets_to_upload[band] = dict(file=files[band], asset=asset.url)
+                    assets_to_upload[band]['asset'] = data['url']
 
-                    # Add into scope of local and remote database
-                    add_instance(engine, asset)
+                add_instance(db, *outbox)
 
-            # Persist database
-        commit(engine)
+        # Persist database
+    commit(db)
 
     return assets_to_upload
@@ -10,8 +10,9 @@ from requests import get as resource_get
 # BDC Scripts
 from bdc_scripts.celery import celery_app
 from bdc_scripts.config import Config
-from bdc_scripts.core.utils import upload_file
+from bdc_scripts.core.utils import upload_files
 from bdc_scripts.radcor.base_task import RadcorTask
+from bdc_scripts.radcor.tasks import replicate_catalog
 from bdc_scripts.radcor.landsat.download import download_landsat_images
 from bdc_scripts.radcor.landsat.publish import publish
 from bdc_scripts.radcor.utils import get_task_activity
@@ -81,6 +82,9 @@ class LandsatTask(RadcorTask):
 
             raise e
 
+        # Push the new catalog records to AWS catalog in background
+        replicate_catalog.delay()
+
         scene['activity_type'] = 'uploadLC8'
         scene['args']['assets'] = assets
 
@@ -94,9 +98,14 @@ class LandsatTask(RadcorTask):
 
         assets = scene['args']['assets']
 
+        files = []
+
         for entry in assets.values():
             file_without_prefix = entry['asset'].replace('{}/'.format(Config.AWS_BUCKET_NAME), '')
-            upload_file(entry['file'], Config.AWS_BUCKET_NAME, file_without_prefix)
+            files.append((entry['file'], file_without_prefix))
+
+        if not upload_files(files, Config.AWS_BUCKET_NAME):
+            raise IOError('Could not upload the files of {}'.format(scene['sceneid']))
 
     @staticmethod
     def espa_done(productdir, pathrow, date):
@@ -167,6 +176,9 @@ def publish_landsat(scene):
     return publish_landsat.publish(scene)
 
 
-@celery_app.task(base=LandsatTask, queue='upload')
+@celery_app.task(base=LandsatTask, queue='upload',
+                 autoretry_for=(IOError,),
+                 retry_backoff=True,
+                 max_retries=3)
 def upload_landsat(scene):
     upload_landsat.upload(scene)
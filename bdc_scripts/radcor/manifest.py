@@ -0,0 +1,169 @@
+"""
+Defines the manifest of published files of a product directory.
+
+The manifest keeps size, modification time, checksum and COG validity of each
+published file, besides the state of files it was generated from. When publish
+runs again for the same scene (i.e after a restart), the files still up to date
+are not generated again.
+
+The checksum is computed once, when the file is recorded. Up to date checks only
+compare size and modification time, unless the checksum verification is enabled
+(``Config.PUBLISH_VERIFY_CHECKSUM``), which reads every file again.
+"""
+
+# Python Native
+import hashlib
+import json
+import logging
+import os
+# 3rdparty
+import gdal
+# BDC Scripts
+from bdc_scripts.config import Config
+
+
+class ProductManifest:
+    """
+    Manifest of published files, stored as ``manifest.json`` in product directory.
+
+    Example:
+        >>> manifest = ProductManifest('/data/Repository/Archive/S2SR_SEN28/2019-01/S2A_MSIL2A_...SAFE')
+        >>> if not manifest.is_up_to_date(cog_file, sources=[jp2_file]):
+        >>>     generate_cogs(jp2_file, cog_file)
+        >>>     manifest.record(cog_file, sources=[jp2_file])
+        >>>     manifest.save()
+    """
+    FILE_NAME = 'manifest.json'
+
+    def __init__(self, productdir: str):
+        self.file = os.path.join(productdir, self.FILE_NAME)
+        self._entries = dict()
+
+        if os.path.exists(self.file):
+            try:
+                with open(self.file) as f:
+                    self._entries = json.load(f)
+            except ValueError as e:
+                logging.warning('Ignoring corrupt manifest {} - {}'.format(self.file, e))
+
+    def get(self, file: str) -> dict:
+        """Retrieve the entry of file or None."""
+        return self._entries.get(os.path.basename(file))
+
+    def is_up_to_date(self, file: str, sources: list = None, verify: bool = None) -> bool:
+        """
+        Check if the file is still the one recorded in manifest.
+
+        The file must exist with the same size and modification time, be a valid COG
+        (when recorded as COG) and the source files must not have changed.
+
+        Args:
+            file (str) - Path to the published file
+            sources (list) - Path to the files used to generate file
+            verify (bool) - Compare the checksum of file too. Defaults to ``Config.PUBLISH_VERIFY_CHECKSUM``
+        """
+        entry = self.get(file)
+
+        if entry is None or not entry.get('cog', True) or _stat(file) != (entry['size'], entry['mtime']):
+            return False
+
+        if verify is None:
+            verify = Config.PUBLISH_VERIFY_CHECKSUM
+
+        if verify and checksum(file) != entry.get('checksum'):
+            logging.warning('Checksum of {} does not match manifest'.format(file))
+            return False
+
+        for source in sources or []:
+            stat = _stat(source)
+
+            if stat is None or list(stat) != entry.get('sources', {}).get(source):
+                return False
+
+        return True
+
+    def is_complete(self, verify: bool = None) -> bool:
+        """Check if there are published files and all of them are up to date (see :meth:`is_up_to_date`)."""
+        directory = os.path.dirname(self.file)
+
+        return bool(self._entries) and all(
+            self.is_up_to_date(os.path.join(directory, name), verify=verify) for name in self._entries
+        )
+
+    def record(self, file: str, sources: list = None, cog: bool = None, **metadata):
+        """
+        Record the current state of file.
+
+        Args:
+            file (str) - Path to the published file
+            sources (list) - Path to the files used to generate file
+            cog (bool) - File is a valid COG. Checked on file when None and it is a GeoTIFF
+            **metadata - Extra properties of file, i.e raster and chunk sizes
+        """
+        size, mtime = _stat(file)
+
+        if cog is None:
+            cog = is_cog(file) if file.endswith('.tif') else True
+
+        entry = dict(
+            size=size,
+            mtime=mtime,
+            checksum=checksum(file),
+            cog=cog,
+            sources={source: list(_stat(source) or []) for source in sources or []}
+        )
+        entry.update(metadata)
+
+        self._entries[os.path.basename(file)] = entry
+
+        return entry
+
+    def save(self):
+        """Write the manifest atomically."""
+        tmp_file = '{}.tmp'.format(self.file)
+
+        with open(tmp_file, 'w') as f:
+            json.dump(self._entries, f)
+
+        os.replace(tmp_file, self.file)
+
+
+def checksum(file: str, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the MD5 checksum of file."""
+    md5 = hashlib.md5()
+
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def is_cog(file: str) -> bool:
+    """Check if the file is a tiled GeoTIFF with overviews. Only the file header is read."""
+    data_set = gdal.Open(file, gdal.GA_ReadOnly)
+
+    if data_set is None:
+        return False
+
+    band = data_set.GetRasterBand(1)
+    block_x, _ = band.GetBlockSize()
+
+    # Striped files have blocks of full width
+    tiled = block_x < data_set.RasterXSize or data_set.RasterXSize <= 512
+
+    valid = tiled and (band.GetOverviewCount() > 0 or max(data_set.RasterXSize, data_set.RasterYSize) <= 512)
+
+    del data_set
+
+    return valid
+
+
+def _stat(file: str):
+    """Retrieve size and modification time of file, or None when file does not exist."""
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime
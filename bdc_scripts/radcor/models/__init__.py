@@ -1,2 +1,3 @@
 from bdc_scripts.radcor.models.activity import RadcorActivity
 from bdc_scripts.radcor.models.activity_history import RadcorActivityHistory
+from bdc_scripts.radcor.models.replication import ReplicationOutbox
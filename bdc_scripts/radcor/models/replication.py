@@ -0,0 +1,38 @@
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, JSON, String, Text
+from bdc_db.models.base_sql import BaseModel
+
+
+class ReplicationOutbox(BaseModel):
+    """
+    Catalog records pending replication to the remote catalog (db_aws).
+
+    Publish writes the records in the same transaction of local catalog, so
+    the remote catalog is never ahead of local one. The records are pushed by
+    the task ``replicate_catalog``.
+    """
+    __tablename__ = 'replication_outbox'
+
+    id = Column(Integer, primary_key=True)
+    model = Column('model', String(64), nullable=False)
+    data = Column('data', JSON, nullable=False)
+    created = Column('created', DateTime, nullable=False, default=datetime.utcnow)
+    attempts = Column('attempts', Integer, nullable=False, default=0)
+    error = Column('error', Text)
+    replicated = Column('replicated', DateTime, index=True)
+
+    @classmethod
+    def collection_item(cls, data: dict):
+        """Create an outbox record of a collection item."""
+        return cls(model='CollectionItem', data=data)
+
+    @classmethod
+    def asset(cls, data: dict, band: dict):
+        """
+        Create an outbox record of an asset.
+
+        Args:
+            data (dict) - Asset values without band_id
+            band (dict) - Restriction of the asset band in remote catalog, i.e dict(name='B04')
+        """
+        return cls(model='Asset', data=dict(data, band=band))
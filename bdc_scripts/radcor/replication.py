@@ -0,0 +1,195 @@
+"""
+Defines the replication of local catalog into the remote catalog (db_aws).
+
+Publish does not write into the remote catalog. It appends the collection items and
+assets to ``ReplicationOutbox`` in the local transaction and the records are
+pushed in batches by :func:`replicate`, so a slow or unavailable remote catalog
+does not stall the publish queue.
+"""
+
+# Python Native
+from datetime import datetime
+import logging
+
+# 3rdparty
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+# BDC Scripts
+from bdc_db.models import db, Asset, Band, CollectionItem
+from bdc_scripts.config import Config
+from bdc_scripts.db import db_aws
+from bdc_scripts.radcor.models import ReplicationOutbox
+from bdc_scripts.radcor.utils import ASSET_KEYS, bulk_get_or_create
+
+
+def pending(batch_size: int):
+    """
+    Retrieve the oldest records pending replication.
+
+    The records are locked until the end of transaction. Records locked by
+    other replicators are skipped.
+    """
+    return db.session.query(ReplicationOutbox) \
+        .filter(ReplicationOutbox.replicated.is_(None)) \
+        .filter(ReplicationOutbox.attempts < Config.REPLICATION_MAX_ATTEMPTS) \
+        .order_by(ReplicationOutbox.id) \
+        .limit(batch_size) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+
+def has_pending() -> bool:
+    """Check if there are records pending replication, including the ones locked by other replicators."""
+    return db.session.query(
+        db.session.query(ReplicationOutbox)
+        .filter(ReplicationOutbox.replicated.is_(None))
+        .filter(ReplicationOutbox.attempts < Config.REPLICATION_MAX_ATTEMPTS)
+        .exists()
+    ).scalar()
+
+
+def replicate(batch_size: int = None) -> int:
+    """
+    Replicate a batch of outbox records into remote catalog.
+
+    The batch is written with a single commit. When the remote catalog rejects the
+    batch, it is bisected until the failing records are isolated, so only their
+    attempts are incremented and the other records are replicated.
+
+    When the remote catalog is unavailable (connection or operational errors), or no
+    record of batch could be replicated, the error is raised without incrementing the
+    attempts, so an outage does not exhaust ``Config.REPLICATION_MAX_ATTEMPTS``.
+
+    Returns:
+        Number of replicated records
+    """
+    records = pending(batch_size or Config.REPLICATION_BATCH_SIZE)
+
+    if not records:
+        db.session.commit()
+        return 0
+
+    replicated = []
+    failures = []
+
+    try:
+        _replicate_records(records, replicated, failures)
+    except Exception as e:
+        logging.warning('Remote catalog unavailable - {}'.format(e))
+        # Keep the records written before the remote catalog went down
+        _mark_replicated(replicated)
+        raise
+
+    if not replicated:
+        # The whole batch failed. The records are kept as they are
+        db.session.rollback()
+        raise failures[-1][1]
+
+    for record, error in failures:
+        record.attempts += 1
+        record.error = str(error)
+
+    _mark_replicated(replicated)
+
+    if failures:
+        logging.warning('Could not replicate {} catalog records'.format(len(failures)))
+
+    logging.info('Replicated {} catalog records'.format(len(replicated)))
+
+    return len(replicated)
+
+
+def _mark_replicated(records: list):
+    now = datetime.utcnow()
+
+    for record in records:
+        record.replicated = now
+        record.error = None
+
+    db.session.commit()
+
+
+def _replicate_records(records: list, replicated: list, failures: list):
+    """
+    Write the records into remote catalog, bisecting the batch when it is rejected.
+
+    Args:
+        records (list) - Outbox records
+        replicated (list) - Receives the replicated records
+        failures (list) - Receives the tuples (record, error) of records that failed alone
+
+    Raises:
+        Connection and operational errors of remote catalog, which stop the bisection
+    """
+    try:
+        items = [record.data for record in records if record.model == 'CollectionItem']
+        assets = [record.data for record in records if record.model == 'Asset']
+
+        _replicate_collection_items(items)
+        _replicate_assets(assets)
+
+        db_aws.session.commit()
+
+        replicated.extend(records)
+        return
+    except Exception as e:
+        db_aws.session.rollback()
+
+        if _is_unavailable(e):
+            raise
+
+        if len(records) == 1:
+            failures.append((records[0], e))
+            return
+
+    middle = len(records) // 2
+
+    # Items come first (outbox order), so assets are written after the items they refer to
+    _replicate_records(records[:middle], replicated, failures)
+    _replicate_records(records[middle:], replicated, failures)
+
+
+def _is_unavailable(error: Exception) -> bool:
+    """Check if the error means the remote catalog is unavailable, instead of rejecting the records."""
+    return isinstance(error, (OperationalError, InterfaceError, OSError)) or \
+        getattr(error, 'connection_invalidated', False)
+
+
+def _replicate_collection_items(items: list):
+    for data in items:
+        item = db_aws.session.query(CollectionItem).filter(CollectionItem.id == data['id']).first()
+
+        if item is None:
+            db_aws.session.add(CollectionItem(**data))
+        else:
+            item.quicklook = data.get('quicklook')
+
+    # Assets refer to the collection items
+    db_aws.session.flush()
+
+
+def _replicate_assets(assets: list):
+    bands = dict()
+    rows = []
+
+    for data in assets:
+        data = dict(data)
+        restriction = data.pop('band')
+
+        key = (data['collection_id'], tuple(sorted(restriction.items())))
+
+        if key not in bands:
+            bands[key] = db_aws.session.query(Band) \
+                .filter_by(collection_id=data['collection_id'], **restriction) \
+                .first()
+
+        if bands[key] is None:
+            logging.warning('Band {} of collection {} not registered on remote catalog. Skipping'.format(
+                restriction, data['collection_id']))
+            continue
+
+        data['band_id'] = bands[key].id
+
+        rows.append(data)
+
+    bulk_get_or_create(Asset, rows, ASSET_KEYS, engine=db_aws)
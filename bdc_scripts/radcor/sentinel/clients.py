@@ -1,39 +1,54 @@
 import json
 import logging
 import os
+import socket
+import threading
+import uuid
 from bdc_scripts.celery.cache import client
-from bdc_scripts.config import CURRENT_DIR
+from bdc_scripts.config import CURRENT_DIR, Config
+
+
+class LeaseLostError(Exception):
+    """The lease of download slot expired and the slot was given to another worker."""
 
 
 class AtomicUser:
     """
     An abstraction of Atomic User. You must use it as context manager. See contextlib.
 
-    Make sure to control the access to the shared resource.
+    Each instance holds a lease of one download slot of the account. While the
+    instance is alive, a heartbeat thread refreshes the lease. Whenever an instance
+    object out of scope, it automatically releases the slot to the Redis pool. When the
+    worker dies, the lease expires and the slot is reclaimed by :meth:`UserClients.reap`.
 
-    Whenever an instance object out of scope, it automatically releases the user to the
-    Redis cache.
+    When the lease is lost anyway (i.e Redis unreachable longer than the lease TTL),
+    :attr:`lost` is set and :meth:`check` raises :class:`LeaseLostError`, so the
+    download stops using a slot already given to another worker.
 
     Example:
-        >>> from bdc_scripts.celery.cache import client
         >>> from bdc_scripts.radcor.sentinel.clients import sentinel_clients
         >>>
-        >>> # Lock the access to the shared resource
-        >>> with client.lock('my_lock'):
-        >>>     user = None
-        >>>     while user is None:
-        >>>         user = sentinel_clients.use()
+        >>> # Wait up to 60 seconds for a free slot
+        >>> user = sentinel_clients.use(timeout=60)
         >>>
-        >>>     with user:
-        >>>         # Do things, download images...
-        >>>         pass
-        >>>     # User is released on redis
-        >>> # Lock released
+        >>> with user:
+        >>>     # Do things, download images...
+        >>>     pass
+        >>> # Slot released on redis
     """
-    def __init__(self, username, password):
+    def __init__(self, username, password, lease, pool=None):
         self.username = username
         self.password = password
+        self.lease = lease
+        self._pool = pool or sentinel_clients
         self._released = False
+        self._stop = threading.Event()
+        self.lost = threading.Event()
+
+        # The thread must not reference the instance, otherwise it is never collected
+        heartbeat = threading.Thread(target=_heartbeat, args=(self._pool, lease, self._stop, self.lost),
+                                     daemon=True, name='lease-{}'.format(username))
+        heartbeat.start()
 
     def __repr__(self):
         return 'AtomicUser({}, released={})'.format(self.username, self._released)
@@ -41,6 +56,16 @@ class AtomicUser:
     def __enter__(self):
         return self
 
+    def check(self):
+        """
+        Ensure the slot is still held.
+
+        Raises:
+            LeaseLostError when the lease was reclaimed
+        """
+        if self.lost.is_set():
+            raise LeaseLostError('Download slot of {} was reclaimed ({})'.format(self.username, self.lease))
+
     def __del__(self):
         self.release()
 
@@ -48,7 +73,8 @@ class AtomicUser:
         """Release atomic user from redis"""
         if not self._released:
             logging.debug('Release {}'.format(self.username))
-            sentinel_clients.done(self.username)
+            self._stop.set()
+            self._pool.done(self.username, self.lease)
 
             self._released = True
 
@@ -57,11 +83,197 @@ class AtomicUser:
         self.release()
 
 
+def _heartbeat(pool, lease, stop, lost):
+    """Refresh the lease until stop is set or the lease is lost, which is signaled on lost."""
+    interval = max(1, Config.SENTINEL_LEASE_TTL / 3)
+
+    while not stop.wait(interval):
+        try:
+            if not pool.refresh(lease):
+                logging.warning('Lease {} expired and was reclaimed while in use'.format(lease))
+                lost.set()
+                return
+        except Exception as e:
+            logging.warning('Could not refresh lease {} - {}'.format(lease, e))
+
+
+def _is_running(pid):
+    """Check if a process of current host is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process exists, owned by another user
+        return True
+
+    return True
+
+
 class UserClients:
-    def __init__(self):
-        self._users = []
-        self._key = 'bdc_scripts:users'
-        self._load_from_disk()
+    """
+    Pool of download slots of SciHub accounts.
+
+    Each account has ``Config.SENTINEL_SLOTS_PER_ACCOUNT`` tokens (its username) in a
+    Redis list. Taking a slot atomically moves a token into the list of slots in use of the
+    current worker (``BRPOPLPUSH``), so workers waiting for a slot are served in
+    order as soon as one is released, without polling.
+
+    Every slot in use has a lease ``<worker>|<username>|<id>`` in a sorted set scored
+    by its expiration time, refreshed by the heartbeat of :class:`AtomicUser`. The
+    expiration times come from Redis clock, so clock skew between workers does not
+    expire live leases.
+    Expired leases (i.e worker killed with SIGKILL) are reclaimed by :meth:`reap`,
+    which runs whenever a worker waits for a slot. The slots of a worker which died
+    before taking the lease are recovered by :meth:`recover` when a worker of same host starts.
+
+    When the slots of an account are reduced (or the account is removed) while its
+    tokens are in use, the excess is recorded and those tokens are dropped when released.
+    The lists of slots in use are registered in a set before the first token is taken, so
+    the reconciliation counts all of them in the same script.
+    """
+    # Give a token back to pool, unless the account has tokens in excess
+    _GIVE_BACK = """
+        local function give_back(tokens, excess, username)
+            if tonumber(redis.call('HGET', excess, username) or '0') > 0 then
+                redis.call('HINCRBY', excess, username, -1)
+            else
+                redis.call('LPUSH', tokens, username)
+            end
+        end
+    """
+
+    # Drop the lease and move the token back to pool only when it was in use,
+    # so a double release (or the release of a reclaimed lease) does not create slots
+    _RELEASE_SCRIPT = _GIVE_BACK + """
+        redis.call('ZREM', KEYS[3], ARGV[2])
+        if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+            give_back(KEYS[2], KEYS[4], ARGV[1])
+            return 1
+        end
+        return 0
+    """
+
+    # Reclaim a lease only when it is still expired, since it may be refreshed meanwhile
+    _REAP_SCRIPT = _GIVE_BACK + """
+        local expiration = redis.call('ZSCORE', KEYS[1], ARGV[1])
+        if not expiration or tonumber(expiration) > tonumber(ARGV[4]) then
+            return 0
+        end
+        redis.call('ZREM', KEYS[1], ARGV[1])
+        if redis.call('LREM', KEYS[2], 1, ARGV[3]) == 1 then
+            give_back(KEYS[3], KEYS[4], ARGV[3])
+            return 1
+        end
+        return 0
+    """
+
+    # Move all tokens in use of a dead worker back to pool, drop its leases and its list of slots
+    _RECOVER_SCRIPT = _GIVE_BACK + """
+        redis.call('SREM', KEYS[5], KEYS[1])
+        local total = 0
+        local username = redis.call('RPOP', KEYS[1])
+        while username do
+            give_back(KEYS[2], KEYS[4], username)
+            total = total + 1
+            username = redis.call('RPOP', KEYS[1])
+        end
+        for _, lease in ipairs(redis.call('ZRANGE', KEYS[3], 0, -1)) do
+            if string.sub(lease, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. '|' then
+                redis.call('ZREM', KEYS[3], lease)
+            end
+        end
+        return total
+    """
+
+    # Adjust the tokens of accounts to the number of slots.
+    # KEYS: accounts, tokens, excess, set of in use lists. ARGV: slots, then username and password pairs
+    _RECONCILE_SCRIPT = """
+        local slots = tonumber(ARGV[1])
+        local desired = {}
+        for i = 2, #ARGV, 2 do
+            desired[ARGV[i]] = slots
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+
+        local counts = {}
+        local function count(list, field)
+            for _, username in ipairs(redis.call('LRANGE', list, 0, -1)) do
+                counts[username] = counts[username] or {free = 0, in_use = 0}
+                counts[username][field] = counts[username][field] + 1
+            end
+        end
+        count(KEYS[2], 'free')
+        for _, in_use in ipairs(redis.call('SMEMBERS', KEYS[4])) do
+            count(in_use, 'in_use')
+        end
+
+        for _, username in ipairs(redis.call('HKEYS', KEYS[1])) do
+            counts[username] = counts[username] or {free = 0, in_use = 0}
+        end
+
+        for username, current in pairs(counts) do
+            local wanted = desired[username] or 0
+            local total = current.free + current.in_use
+            local excess = 0
+            if total < wanted then
+                for _ = 1, wanted - total do
+                    redis.call('LPUSH', KEYS[2], username)
+                end
+            elseif total > wanted then
+                local removed = math.min(current.free, total - wanted)
+                if removed > 0 then
+                    redis.call('LREM', KEYS[2], removed, username)
+                end
+                excess = total - wanted - removed
+            end
+            if excess > 0 then
+                redis.call('HSET', KEYS[3], username, excess)
+            else
+                redis.call('HDEL', KEYS[3], username)
+            end
+            if wanted == 0 then
+                redis.call('HDEL', KEYS[1], username)
+            end
+        end
+        return 1
+    """
+
+    def __init__(self, users=None, redis_client=None):
+        """
+        Create the pool of accounts.
+
+        Args:
+            users (dict) - Accounts as {username: {"password": ...}}. Default is "sentinel" entry of secrets.json
+            redis_client (redis.Redis) - Redis client. Default is the shared client of bdc_scripts
+        """
+        self._client = redis_client or client
+        self._key = 'bdc_scripts:sentinel'
+        self._accounts_key = '{}:accounts'.format(self._key)
+        self._tokens_key = '{}:tokens'.format(self._key)
+        self._leases_key = '{}:leases'.format(self._key)
+        self._excess_key = '{}:excess'.format(self._key)
+        self._workers_key = '{}:workers'.format(self._key)
+        self._release = self._client.register_script(self._RELEASE_SCRIPT)
+        self._reap = self._client.register_script(self._REAP_SCRIPT)
+        self._recover = self._client.register_script(self._RECOVER_SCRIPT)
+        self._reconcile = self._client.register_script(self._RECONCILE_SCRIPT)
+
+        self._register(users if users is not None else self._load_from_disk())
+
+    def now(self):
+        """Retrieve the current time of Redis server, shared by all workers."""
+        seconds, microseconds = self._client.time()
+
+        return seconds + microseconds / 1000000.
+
+    @property
+    def worker(self):
+        """Identifier of current worker process."""
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def _in_use_key(self, worker=None):
+        return '{}:in_use:{}'.format(self._key, worker or self.worker)
 
     def _load_from_disk(self):
         file = os.path.join(os.path.dirname(CURRENT_DIR), 'secrets.json')
@@ -75,37 +287,152 @@ class UserClients:
 
         assert 'sentinel' in data
 
-        self.users = data['sentinel']
+        return data['sentinel']
+
+    def _register(self, users):
+        """
+        Reconcile the pool with the accounts.
+
+        Each account gets ``Config.SENTINEL_SLOTS_PER_ACCOUNT`` tokens, counting the
+        ones in use. Tokens of accounts not listed anymore are dropped.
+
+        The slots in use are counted inside the script, so a slot taken meanwhile is
+        never counted as missing.
+        """
+        args = [Config.SENTINEL_SLOTS_PER_ACCOUNT]
+
+        for username, value in users.items():
+            args.extend([username, value['password']])
+
+        self._reconcile(keys=[self._accounts_key, self._tokens_key, self._excess_key, self._workers_key], args=args)
 
     @property
     def users(self):
-        return json.loads(client.get(self._key))
+        """Retrieve the accounts with password and number of slots in use."""
+        free = [token.decode() for token in self._client.lrange(self._tokens_key, 0, -1)]
 
-    @users.setter
-    def users(self, obj):
-        client.set(self._key, json.dumps(obj))
+        return {
+            username.decode(): dict(
+                password=password.decode(),
+                count=Config.SENTINEL_SLOTS_PER_ACCOUNT - free.count(username.decode())
+            )
+            for username, password in self._client.hgetall(self._accounts_key).items()
+        }
 
-    def use(self):
-        users = self.users
+    def use(self, timeout=None):
+        """
+        Take a download slot.
 
-        for username, value in users.items():
-            if value['count'] < 2:
+        Args:
+            timeout (int) - Seconds to wait for a free slot. 0 waits forever and None does not wait
+
+        Returns:
+            AtomicUser The account of slot or None when there is no free slot
+        """
+        self.reap()
+
+        # Registered before taking a token, so the reconciliation always counts the slots of this worker
+        self._client.sadd(self._workers_key, self._in_use_key())
+
+        if timeout is None:
+            username = self._client.rpoplpush(self._tokens_key, self._in_use_key())
+        else:
+            username = self._client.brpoplpush(self._tokens_key, self._in_use_key(), timeout=timeout)
+
+        if username is None:
+            return None
+
+        username = username.decode()
+
+        lease = '{}|{}|{}'.format(self.worker, username, uuid.uuid4().hex)
+
+        self._client.zadd(self._leases_key, {lease: self.now() + Config.SENTINEL_LEASE_TTL})
+
+        logging.debug('User {}'.format(username))
+
+        return AtomicUser(username, self._client.hget(self._accounts_key, username).decode(), lease, pool=self)
+
+    def refresh(self, lease):
+        """
+        Extend the expiration of a lease.
+
+        Returns:
+            bool False when lease does not exist anymore (reclaimed)
+        """
+        expiration = self.now() + Config.SENTINEL_LEASE_TTL
+
+        # XX only updates existing members, CH counts the updated ones
+        return bool(self._client.zadd(self._leases_key, {lease: expiration}, xx=True, ch=True))
+
+    def done(self, username, lease=''):
+        """Release a download slot of account taken by current worker."""
+        released = self._release(keys=[self._in_use_key(), self._tokens_key, self._leases_key, self._excess_key],
+                                 args=[username, lease])
+
+        if not released:
+            logging.warning('Slot of {} was not in use by {}'.format(username, self.worker))
+
+    def reap(self):
+        """
+        Reclaim the slots of expired leases.
+
+        Returns:
+            int Number of reclaimed slots
+        """
+        now = self.now()
+
+        total = 0
+
+        for lease in self._client.zrangebyscore(self._leases_key, '-inf', now):
+            lease = lease.decode()
+            worker, username, _ = lease.split('|')
+
+            reclaimed = self._reap(keys=[self._leases_key, self._in_use_key(worker), self._tokens_key,
+                                         self._excess_key],
+                                   args=[lease, worker, username, now])
+
+            if reclaimed:
+                logging.warning('Reclaimed download slot of {} from {} - lease expired'.format(username, worker))
+                total += reclaimed
+
+        return total
+
+    def recover(self):
+        """
+        Release the slots in use of the dead worker processes of current host.
+
+        Only the processes which are not running anymore are recovered, so the slots
+        of sibling workers still downloading are kept. The slots of other hosts (or of
+        a pid already reused) are reclaimed when their leases expire (see :meth:`reap`).
+
+        Returns:
+            int Number of recovered slots
+        """
+        prefix = self._in_use_key('{}:'.format(socket.gethostname()))
+
+        total = 0
+
+        for key in self._client.smembers(self._workers_key):
+            key = key.decode()
 
-                logging.debug('User {} - {}'.format(username, value['count']))
-                value['count'] += 1
+            if not key.startswith(prefix):
+                continue
 
-                self.users = users
+            worker = key[len('{}:in_use:'.format(self._key)):]
+            pid = worker.rsplit(':', 1)[-1]
 
-                return AtomicUser(username, value['password'])
-        return None
+            if not pid.isdigit() or _is_running(int(pid)):
+                continue
 
-    def done(self, username):
-        users = self.users
-        assert username in users.keys()
+            recovered = self._recover(keys=[key, self._tokens_key, self._leases_key, self._excess_key,
+                                            self._workers_key],
+                                      args=[worker])
 
-        users[username]['count'] -= 1
+            if recovered:
+                logging.warning('Recovered {} download slots of dead worker {}'.format(recovered, worker))
+                total += recovered
 
-        self.users = users
+        return total
 
 
-sentinel_clients = UserClients()
\ No newline at end of file
+sentinel_clients = UserClients()
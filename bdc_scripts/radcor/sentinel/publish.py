@@ -5,20 +5,18 @@ import os
 from datetime import datetime
 from pathlib import Path
 
-# 3rd-party
-import gdal
-import numpy
-from numpngw import write_png
-from skimage.transform import resize
-
 # BDC Scripts
 from bdc_db.models import db, Asset, Band, CollectionItem, CollectionTile
 from bdc_scripts.config import Config
-from bdc_scripts.db import add_instance, commit, db_aws
-from bdc_scripts.core.utils import generate_cogs, generate_evi_ndvi
+from bdc_scripts.core.mask import load_mask, mask_counts
+from bdc_scripts.core.quicklook import generate_quicklook
+from bdc_scripts.db import add_instance, commit
+from bdc_scripts.core.utils import generate_cogs_parallel, generate_evi_ndvi
 from bdc_scripts.radcor.forms import CollectionItemForm
-from bdc_scripts.radcor.utils import get_or_create_model
-from bdc_scripts.radcor.models import RadcorActivity
+from bdc_scripts.radcor.manifest import ProductManifest
+from bdc_scripts.radcor.utils import ASSET_KEYS, bulk_get_or_create
+from bdc_scripts.radcor.models import RadcorActivity, ReplicationOutbox
+from bdc_scripts.radcor.sentinel.safe import list_images
 
 
 BAND_MAP = {
@@ -87,8 +85,14 @@ def publish(collection_item: CollectionItem, scene: RadcorActivity):
     if not os.path.exists(productdir):
         os.makedirs(productdir)
 
+    # Files published previously for this scene
+    manifest = ProductManifest(productdir)
+
+    # Vegetation indices are converted to COG in place, so they are checked against the bands they come from
+    vi_sources = [files['red'], files['nir'], files['blue']]
+
     # Create vegetation index
-    generate_vi(file_basename, productdir, files)
+    generate_vi(file_basename, productdir, files, manifest=manifest, sources=vi_sources)
 
     bands.append('NDVI')
     bands.append('EVI')
@@ -96,127 +100,163 @@ def publish(collection_item: CollectionItem, scene: RadcorActivity):
     BAND_MAP['NDVI'] = 'ndvi'
     BAND_MAP['EVI'] = 'evi'
 
+    conversions = []
+    # Raster and chunk sizes of each COG file
+    cogs = {}
+    # Files used to generate each COG file
+    sources = {}
+
     for sband in bands:
         band = BAND_MAP[sband]
-        file = files[band]
 
         # Set destination of COG file
         cog_file_name = '{}_{}.tif'.format(file_basename, sband)
         cog_file_path = os.path.join(productdir, cog_file_name)
 
-        files[band] = generate_cogs(file, cog_file_path)
-
-    source = scene.sceneid.split('_')[0]
-
-    assets_to_upload = {}
+        sources[cog_file_path] = vi_sources if band in ('ndvi', 'evi') else [files[band]]
 
-    for instance in ['local', 'aws']:
-        engine_instance = {
-            'local': db,
-            'aws': db_aws
-        }
-        engine = engine_instance[instance]
-
-        # Skip catalog on aws for digital number
-        if collection_item.collection_id == 'S2TOA' and instance == 'aws':
+        if manifest.is_up_to_date(cog_file_path, sources=sources[cog_file_path]):
+            logging.info('COG {} is up to date. Skipping'.format(cog_file_path))
+            cogs[cog_file_path] = manifest.get(cog_file_path)
+            files[band] = cog_file_path
             continue
 
-        if instance == 'aws':
-            asset_url = product_uri.replace('/Repository/Archive', Config.AWS_BUCKET_NAME)
-        else:
-            asset_url = product_uri
-
-        collection_bands = engine.session.query(Band).filter(Band.collection_id == scene.collection_id).all()
+        conversions.append(dict(
+            input_data_set_path=files[band],
+            file_path=cog_file_path,
+            # Quality band values are classes, so its overviews must not be interpolated
+            resampling='NEAREST' if band == 'quality' else None
+        ))
 
-        with engine.session.begin_nested():
-            with engine.session.no_autoflush:
-                # Add collection item to the session if not present
-                if collection_item not in engine.session:
-                    item = engine.session.query(CollectionItem).filter(CollectionItem.id == collection_item.id).first()
+        files[band] = cog_file_path
 
-                    if not item:
-                        cloned_properties = CollectionItemForm().dump(collection_item)
-                        cloned_item = CollectionItem(**cloned_properties)
-                        engine.session.add(cloned_item)
+    for conversion, metadata in generate_cogs_parallel(conversions):
+        cog_file_path = conversion['file_path']
+        cogs[cog_file_path] = metadata
 
-                # Convert original format to COG
-                for sband in bands:
-                    # Set destination of COG file
-                    cog_file_name = '{}_{}.tif'.format(file_basename, sband)
-                    cog_file_path = os.path.join(productdir, cog_file_name)
+        logging.info('COG {} done'.format(cog_file_path))
 
-                    asset_dataset = gdal.Open(cog_file_path)
+        metadata = {key: value for key, value in metadata.items() if key != 'file'}
 
-                    raster_band = asset_dataset.GetRasterBand(1)
+        manifest.record(cog_file_path, sources=sources[cog_file_path], **metadata)
+        manifest.save()
 
-                    chunk_x, chunk_y = raster_band.GetBlockSize()
-
-                    band_model = next(filter(lambda b: b.name == sband, collection_bands), None)
+    source = scene.sceneid.split('_')[0]
 
-                    if band_model is None:
-                        logging.warning('Band {} not registered on database. Skipping'.format(sband))
-                        continue
+    assets_to_upload = {}
 
-                    defaults = dict(
-                        source=source,
-                        url='{}/{}'.format(asset_url, cog_file_name),
-                        raster_size_x=asset_dataset.RasterXSize,
-                        raster_size_y=asset_dataset.RasterYSize,
-                        raster_size_t=1,
-                        chunk_size_t=1,
-                        chunk_size_x=chunk_x,
-                        chunk_size_y=chunk_y
+    # Create Qlook file
+    pngname = os.path.join(productdir, file_basename + '.png')
+    if not os.path.exists(pngname):
+        create_qlook_file(pngname, files['qlfile'])
+
+    # Skip catalog on aws for digital number
+    replicate = collection_item.collection_id != 'S2TOA'
+    aws_url = product_uri.replace('/Repository/Archive', Config.AWS_BUCKET_NAME)
+
+    collection_bands = db.session.query(Band).filter(Band.collection_id == scene.collection_id).all()
+
+    with db.session.begin_nested():
+        with db.session.no_autoflush:
+            # Add collection item to the session if not present
+            if collection_item not in db.session:
+                item = db.session.query(CollectionItem).filter(CollectionItem.id == collection_item.id).first()
+
+                if not item:
+                    cloned_properties = CollectionItemForm().dump(collection_item)
+                    cloned_item = CollectionItem(**cloned_properties)
+                    db.session.add(cloned_item)
+
+            rows = []
+            registered_bands = []
+
+            # Register the COG files of all bands at once
+            for sband in bands:
+                # Set destination of COG file
+                cog_file_name = '{}_{}.tif'.format(file_basename, sband)
+                cog_file_path = os.path.join(productdir, cog_file_name)
+
+                cog = cogs[cog_file_path]
+
+                band_model = next(filter(lambda b: b.name == sband, collection_bands), None)
+
+                if band_model is None:
+                    logging.warning('Band {} not registered on database. Skipping'.format(sband))
+                    continue
+
+                rows.append(dict(
+                    collection_id=scene.collection_id,
+                    band_id=band_model.id,
+                    grs_schema_id=scene.collection.grs_schema_id,
+                    tile_id=collection_item.tile_id,
+                    collection_item_id=collection_item.id,
+                    source=source,
+                    url='{}/{}'.format(product_uri, cog_file_name),
+                    raster_size_x=cog['raster_size_x'],
+                    raster_size_y=cog['raster_size_y'],
+                    raster_size_t=1,
+                    chunk_size_t=1,
+                    chunk_size_x=cog['chunk_size_x'],
+                    chunk_size_y=cog['chunk_size_y']
+                ))
+                registered_bands.append((sband, cog_file_path))
+
+            assets = bulk_get_or_create(Asset, rows, ASSET_KEYS, engine=db)
+
+            for (sband, cog_file_path), asset in zip(registered_bands, assets):
+                assets_to_upload[sband] = (dict(file=cog_file_path, asset=asset.url))
+
+            normalized_quicklook_path = os.path.normpath('{}/{}'.format(product_uri, os.path.basename(pngname)))
+            assets_to_upload['quicklook'] = dict(asset=normalized_quicklook_path, file=pngname)
+
+            c_item = db.session.query(CollectionItem).filter(
+                CollectionItem.id == collection_item.id
+            ).first()
+            if c_item:
+                c_item.quicklook = normalized_quicklook_path
+                add_instance(db, c_item)
+
+            # The AWS catalog is written by replicate_catalog
+            if replicate:
+                aws_quicklook_path = os.path.normpath('{}/{}'.format(aws_url, os.path.basename(pngname)))
+                assets_to_upload['quicklook']['asset'] = aws_quicklook_path
+
+                outbox = [
+                    ReplicationOutbox.collection_item(
+                        dict(CollectionItemForm().dump(collection_item), quicklook=aws_quicklook_path)
                     )
-                    asset, _ = get_or_create_model(
-                        Asset,
-                        defaults=defaults,
-                        engine=engine,
-                        collection_id=scene.collection_id,
-                        band_id=band_model.id,
-                        grs_schema_id=scene.collection.grs_schema_id,
-                        tile_id=collection_item.tile_id,
-                        collection_item_id=collection_item.id,
-                    )
-
-                    assets_to_upload[sband] = (dict(file=cog_file_path, asset=asset.url))
+                ]
 
-                    del asset_dataset
+                for (sband, _), row in zip(registered_bands, rows):
+                    data = {key: value for key, value in row.items() if key != 'band_id'}
+                    data['url'] = data['url'].replace(product_uri, aws_url)
 
-                # Create Qlook file
-                pngname = os.path.join(productdir, file_basename + '.png')
-                if not os.path.exists(pngname):
-                    create_qlook_file(pngname, files['qlfile'])
+                    outbox.append(ReplicationOutbox.asset(data, band=dict(name=sband)))
 
-                normalized_quicklook_path = os.path.normpath('{}/{}'.format(asset_url, os.path.basename(pngname)))
-                assets_to_upload['quicklook'] = dict(asset=normalized_quicklook_path, file=pngname)
+                    assets_to_upload[sband]['asset'] = data['url']
 
-                c_item = engine.session.query(CollectionItem).filter(
-                    CollectionItem.id == collection_item.id
-                ).first()
-                if c_item:
-                    c_item.quicklook = normalized_quicklook_path
-                    add_instance(engine, c_item)
+                add_instance(db, *outbox)
 
-        commit(engine)
+    commit(db)
 
     return assets_to_upload
 
 
 def create_qlook_file(pngname, qlfile):
-    image = numpy.ones((768, 768, 3,), dtype=numpy.uint8)
-    dataset = gdal.Open(qlfile, gdal.GA_ReadOnly)
-    for nb in [0, 1, 2]:
-        raster = dataset.GetRasterBand(nb + 1).ReadAsArray(0, 0, dataset.RasterXSize, dataset.RasterYSize)
-        image[:, :, nb] = resize(raster, (768, 768), order=1, preserve_range=True).astype(numpy.uint8)
-        write_png(pngname, image, transparent=(0, 0, 0))
+    """Generate the quick look of scene from the true color image (TCI) file."""
+    return generate_quicklook(pngname, [qlfile])
 
 
-def generate_vi(identifier, productdir, files):
+def generate_vi(identifier, productdir, files, manifest=None, sources=None):
     ndvi_name = os.path.join(productdir, identifier+"_NDVI.tif")
     evi_name = os.path.join(productdir, identifier+"_EVI.tif")
     files['ndvi'] = ndvi_name
     files['evi'] = evi_name
 
+    if manifest is not None and all(manifest.is_up_to_date(f, sources=sources) for f in [ndvi_name, evi_name]):
+        logging.info('Vegetation indices of {} are up to date. Skipping'.format(identifier))
+        return
+
     generate_evi_ndvi(files['red'], files['nir'], files['blue'], evi_name, ndvi_name)
 
 
@@ -227,17 +267,13 @@ def filter_jp2_files(directory, pattern):
 
 
 def get_jp2_files(scene: RadcorActivity):
-    # Find all jp2 files in L2A SAFE
+    # Find all jp2 files in extracted L2A SAFE
     sentinel_folder_data = scene.args.get('file', '')
     template = "T*.jp2"
-    jp2files = [os.path.join(dirpath, f)
-                for dirpath, dirnames, files in os.walk("{0}".format(sentinel_folder_data))
-                for f in fnmatch.filter(files, template)]
+    jp2files = list_images(sentinel_folder_data, template)
     if len(jp2files) <= 1:
         template = "L2A_T*.jp2"
-        jp2files = [os.path.join(dirpath, f)
-                    for dirpath, dirnames, files in os.walk("{0}".format(sentinel_folder_data))
-                    for f in fnmatch.filter(files, template)]
+        jp2files = list_images(sentinel_folder_data, template)
         if len(jp2files) <= 1:
             msg = 'No {} files found in {}'.format(template, sentinel_folder_data)
             logging.warning(msg)
@@ -246,8 +282,13 @@ def get_jp2_files(scene: RadcorActivity):
     return jp2files
 
 
-def compute_cloud_cover(raster):
+def compute_cloud_cover(scl_file):
     """
+    Evaluate the cloud cover (%) of a scene classification (SCL) file.
+
+    The decoded mask is kept as ``<name>_mask.tif`` next to scl_file, so the
+    next evaluations skip the decoding (see :func:`bdc_scripts.core.mask.load_mask`).
+
     Label Classification
     0      NO_DATA
     1      SATURATED_OR_DEFECTIVE
@@ -262,15 +303,6 @@ def compute_cloud_cover(raster):
     10     THIN_CIRRUS
     11     SNOW
     """
-    unique, counts = numpy.unique(raster, return_counts=True)
-    clear = 0.
-    cloud = 0.
-    for i in range(0, unique.shape[0]):
-        if unique[i] == 0:
-            continue
-        elif unique[i] in [1, 2, 3, 8, 9, 10]:
-            cloud += float(counts[i])
-        else:
-            clear += float(counts[i])
+    _, clear, cloud = mask_counts(load_mask(scl_file, 'S2_SCL_COVER'))
 
-    return int(round(100. * cloud / (clear + cloud), 0))
+    return int(round(100. * float(cloud) / (clear + cloud), 0))
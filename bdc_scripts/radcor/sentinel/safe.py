@@ -0,0 +1,98 @@
+"""
+Defines the layout of Sentinel-2 SAFE products.
+
+Only the members of SAFE zip used afterwards are extracted: sen2cor needs the
+L1C bands and metadata (masks, auxiliary data), publish of L1C products (S2TOA) needs
+the same bands and the true color image, while publish of L2A products needs
+the finest resolution of each band. Image files are listed from the ``IMG_DATA``
+directories of extracted SAFE folders only.
+"""
+
+# Python Native
+import fnmatch
+import glob
+import os
+import posixpath
+
+
+# Bands of L1C products used by sen2cor
+SEN2COR_BANDS = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12')
+
+# Bands of L1C products used by sen2cor and by publish of raw products (the quick look band)
+L1C_BANDS = SEN2COR_BANDS + ('TCI',)
+
+# Bands of L2A products used by publish (including the quick look band)
+PUBLISH_BANDS = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12',
+                 'SCL', 'TCI')
+
+# Members used neither by sen2cor nor by publish: HTML report, schemas and previews
+SKIPPED_MEMBERS = ('*/HTML/*', '*/rep_info/*', '*_PVI.jp2')
+
+
+def safe_root(names):
+    """Retrieve the SAFE folder name from the member names of zip."""
+    return names[0].split('/')[0]
+
+
+def get_band(name):
+    """Retrieve the band of a SAFE image (i.e B02 from T23LLF_20190101T132231_B02_10m.jp2)."""
+    parts = posixpath.basename(name)[:-len('.jp2')].split('_')
+
+    return parts[-2] if parts[-1].endswith('m') else parts[-1]
+
+
+def safe_members(names, bands=None):
+    """
+    Select the members of SAFE zip to be extracted.
+
+    Images of L1C products are kept when their band is used by sen2cor or by the
+    publish of L1C products (S2TOA), which also reads the true color image as quick
+    look. Images of L2A products are kept for the finest resolution of each band
+    used by publish. Metadata and masks are
+    always kept, except the members in ``SKIPPED_MEMBERS``.
+
+    Args:
+        names (list) - Member names of zip
+        bands (list) - Bands to keep. Default is L1C_BANDS for L1C and PUBLISH_BANDS for L2A
+
+    Returns:
+        list Names of members to extract
+    """
+    l2a = 'MSIL2A' in safe_root(names)
+
+    if bands is None:
+        bands = PUBLISH_BANDS if l2a else L1C_BANDS
+
+    selected = []
+    found_bands = set()
+
+    for name in sorted(names):
+        if any(fnmatch.fnmatch(name, pattern) for pattern in SKIPPED_MEMBERS):
+            continue
+
+        if '/IMG_DATA/' in name and name.endswith('.jp2'):
+            band = get_band(name)
+
+            # Resolution folders are sorted from the finest (R10m) to the coarsest (R60m)
+            if band not in bands or (l2a and band in found_bands):
+                continue
+
+            found_bands.add(band)
+
+        selected.append(name)
+
+    return selected
+
+
+def list_images(directory, pattern):
+    """
+    List the images of SAFE folder matching the pattern.
+
+    Args:
+        directory (str) - Path to extracted SAFE folder
+        pattern (str) - Pattern of image file names (i.e T*.jp2)
+
+    Returns:
+        list Path to the images
+    """
+    return glob.glob(os.path.join(directory, 'GRANULE', '*', 'IMG_DATA', '**', pattern), recursive=True)
@@ -5,7 +5,6 @@ Describes the Celery Tasks definition of Sentinel products
 # Python Native
 import logging
 import os
-import time
 from datetime import datetime
 from zipfile import ZipFile
 
@@ -17,19 +16,17 @@ from bdc_db.models import db
 
 # BDC Scripts
 from bdc_scripts.celery import celery_app
-from bdc_scripts.celery.cache import lock_handler
-from bdc_scripts.core.utils import extractall, is_valid, upload_file
+from bdc_scripts.core.utils import extractall, is_valid, upload_files
 from bdc_scripts.config import Config
 from bdc_scripts.radcor.base_task import RadcorTask
-from bdc_scripts.radcor.sentinel.clients import sentinel_clients
+from bdc_scripts.radcor.tasks import replicate_catalog
+from bdc_scripts.radcor.sentinel.clients import LeaseLostError, sentinel_clients
 from bdc_scripts.radcor.sentinel.download import download_sentinel_images
 from bdc_scripts.radcor.sentinel.publish import publish
+from bdc_scripts.radcor.sentinel.safe import safe_members, safe_root
 from bdc_scripts.radcor.sentinel.correction import correction_sen2cor255, correction_sen2cor280
 
 
-lock = lock_handler.lock('sentinel_download_lock_4')
-
-
 class SentinelTask(RadcorTask):
     def get_user(self):
         """
@@ -45,19 +42,12 @@ class SentinelTask(RadcorTask):
         """
         user = None
 
-        while lock.locked():
-            logging.info('Resource locked....')
-            time.sleep(1)
-
-        lock.acquire(blocking=True)
         while user is None:
-            user = sentinel_clients.use()
+            # Blocks until a slot is released. Waiting workers are served in order
+            user = sentinel_clients.use(timeout=60)
 
             if user is None:
                 logging.info('Waiting for available user to download...')
-                time.sleep(5)
-
-        lock.release()
 
         return user
 
@@ -113,28 +103,31 @@ class SentinelTask(RadcorTask):
                     collection_item.cloud_cover = cloud
 
                 try:
-                    valid = True
+                    valid = False
 
                     if os.path.exists(zip_file_name):
                         logging.debug('zip file exists')
+                        # Structural check only (central directory and member sizes)
                         valid = is_valid(zip_file_name)
 
-                    if not os.path.exists(zip_file_name) or not valid:
+                    if not valid:
                         # Download from Copernicus
-                        download_sentinel_images(link, zip_file_name, user)
+                        checksum = download_sentinel_images(link, zip_file_name, user)
 
-                        # Check if file is valid
-                        valid = is_valid(zip_file_name)
+                        # File hashed while downloading. Check it only when there is no provider checksum
+                        valid = checksum is not None or is_valid(zip_file_name)
 
                     if not valid:
                         raise IOError('Invalid zip file "{}"'.format(zip_file_name))
-                    else:
-                        extractall(zip_file_name)
 
-                    ### Get extracted zip folder name
                     with ZipFile(zip_file_name) as zipObj:
                         listOfiles = zipObj.namelist()
-                        extracted_file_path = os.path.join(product_dir, '{}'.format(listOfiles[0]))[:-1]
+
+                    # Extract only the bands and metadata used by sen2cor and publish
+                    extractall(zip_file_name, members=safe_members(listOfiles))
+
+                    ### Get extracted zip folder name
+                    extracted_file_path = os.path.join(product_dir, safe_root(listOfiles))
 
                     logging.debug('Done download.')
                     activity_args['file'] = extracted_file_path
@@ -211,6 +204,9 @@ class SentinelTask(RadcorTask):
             logging.error('An error occurred during task execution', e)
             raise e
 
+        # Push the new catalog records to AWS catalog in background
+        replicate_catalog.delay()
+
         # Create new activity 'uploadS2' to continue task chain
         scene['activity_type'] = 'uploadS2'
         scene['args']['assets'] = assets
@@ -225,22 +221,32 @@ class SentinelTask(RadcorTask):
 
         assets = scene['args']['assets']
 
+        files = []
+
         for entry in assets.values():
             file_without_prefix = entry['asset'].replace('{}/'.format(Config.AWS_BUCKET_NAME), '')
             logging.warning('Uploading {} to BUCKET {} - {}'.format(entry['file'], Config.AWS_BUCKET_NAME, file_without_prefix))
-            upload_file(entry['file'], Config.AWS_BUCKET_NAME, file_without_prefix)
+            files.append((entry['file'], file_without_prefix))
+
+        if not upload_files(files, Config.AWS_BUCKET_NAME):
+            raise IOError('Could not upload the files of {}'.format(scene['sceneid']))
 
 
 # TODO: Sometimes, copernicus reject the connection even using only 2 concurrent connection
 # We should set "autoretry_for" and retry_kwargs={'max_retries': 3} to retry
 # task execution since it seems to be bug related to the api
-@celery_app.task(base=SentinelTask, queue='download')
+@celery_app.task(base=SentinelTask, queue='download',
+                 autoretry_for=(LeaseLostError,),
+                 retry_backoff=True)
 def download_sentinel(scene):
     """
     Represents a celery task definition for handling Sentinel Download files
 
     This celery tasks listen only for queues 'download'.
 
+    When the download slot is reclaimed during the download, the task is retried:
+    it takes a new slot and resumes the partial file.
+
     Args:
         scene (dict): Radcor Activity
 
@@ -290,7 +296,10 @@ def publish_sentinel(scene):
     return publish_sentinel.publish(scene)
 
 
-@celery_app.task(base=SentinelTask, queue='upload')
+@celery_app.task(base=SentinelTask, queue='upload',
+                 autoretry_for=(IOError,),
+                 retry_backoff=True,
+                 max_retries=3)
 def upload_sentinel(scene):
     """
     Represents a celery task definition for handling Sentinel
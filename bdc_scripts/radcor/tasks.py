@@ -0,0 +1,67 @@
+"""
+Describes the Celery Tasks shared by the radcor collections
+"""
+
+# Python Native
+import logging
+import time
+
+# 3rdparty
+from redis.exceptions import LockError
+
+# BDC Scripts
+from bdc_scripts.celery import celery_app
+from bdc_scripts.celery.cache import lock_handler
+from bdc_scripts.config import Config
+from bdc_scripts.radcor.replication import has_pending, replicate
+
+
+# Only one replicator drains the outbox at a time
+replication_lock = lock_handler.lock('bdc_scripts:replication_lock', timeout=Config.REPLICATION_LOCK_TIMEOUT)
+
+
+@celery_app.task(queue='replication',
+                 autoretry_for=(Exception,),
+                 retry_backoff=True,
+                 max_retries=Config.REPLICATION_MAX_ATTEMPTS)
+def replicate_catalog():
+    """
+    Represents a celery task definition for replicating the catalog records into db_aws.
+
+    This celery tasks listen only for queues 'replication'. Besides publish, the task
+    runs every ``Config.REPLICATION_SWEEP_INTERVAL`` seconds (celery beat), so records
+    are not stranded when the triggers are lost.
+
+    The outbox is drained in batches of ``Config.REPLICATION_BATCH_SIZE`` for at most half
+    of lock timeout. When another replicator is already running, the task does nothing,
+    since that replicator checks the outbox again after releasing the lock. Any record
+    left in outbox after the lock is released is enqueued again.
+
+    Returns:
+        Number of replicated records
+    """
+    if not replication_lock.acquire(blocking=False):
+        logging.info('Catalog replication already running')
+        return 0
+
+    total = 0
+    deadline = time.time() + Config.REPLICATION_LOCK_TIMEOUT / 2
+
+    try:
+        while time.time() < deadline:
+            replicated = replicate()
+            total += replicated
+
+            if replicated < Config.REPLICATION_BATCH_SIZE:
+                break
+    finally:
+        try:
+            replication_lock.release()
+        except LockError:
+            logging.warning('Replication lock expired before release')
+
+    # Records added while the lock was held, or not drained before the deadline
+    if has_pending():
+        replicate_catalog.delay()
+
+    return total
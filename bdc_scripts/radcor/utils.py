@@ -5,6 +5,8 @@ import logging
 
 # 3rdparty
 from celery import chain, current_task, group
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
 import requests
 
 # BDC Scripts
@@ -13,6 +15,10 @@ from bdc_scripts.radcor.models import RadcorActivityHistory
 from bdc_scripts.radcor.sentinel.clients import sentinel_clients
 
 
+# Columns which identify an Asset of a collection item
+ASSET_KEYS = ('collection_id', 'band_id', 'grs_schema_id', 'tile_id', 'collection_item_id')
+
+
 def get_or_create_model(model_class, defaults=None, engine=None, **restrictions):
     """
     Utility method for looking up an object with the given restrictions, creating
@@ -43,6 +49,57 @@ def get_or_create_model(model_class, defaults=None, engine=None, **restrictions)
     return instance, True
 
 
+def bulk_get_or_create(model_class, rows, keys, engine=None):
+    """
+    Bulk version of get_or_create_model.
+
+    The existing rows are retrieved in a single query and the missing ones are
+    inserted at once with ``INSERT ... ON CONFLICT DO NOTHING``, so the cost does
+    not grow with the number of round trips to database.
+
+    Args:
+        model_class (BaseModel) - Base Model of Brazil Data Cube DB
+        rows (list) - Values of each model instance
+        keys (tuple) - Columns which identify a model instance
+        engine (DatabaseWrapper) - Database engine. Default is db
+    Returns:
+        list Model instances in the same order of rows. The created instances are not attached to session
+    """
+    if not engine:
+        engine = db
+
+    if not rows:
+        return []
+
+    identifiers = [tuple(row[key] for key in keys) for row in rows]
+
+    restriction = tuple_(*[getattr(model_class, key) for key in keys]).in_(set(identifiers))
+
+    existing = {
+        tuple(getattr(instance, key) for key in keys): instance
+        for instance in engine.session.query(model_class).filter(restriction).all()
+    }
+
+    missing = dict()
+
+    for identifier, row in zip(identifiers, rows):
+        if identifier not in existing:
+            missing.setdefault(identifier, row)
+
+    if missing:
+        # Persist pending instances which the new rows may refer to
+        engine.session.flush()
+
+        statement = insert(model_class.__table__).values(list(missing.values())).on_conflict_do_nothing()
+
+        engine.session.execute(statement)
+
+    return [
+        existing[identifier] if identifier in existing else model_class(**row)
+        for identifier, row in zip(identifiers, rows)
+    ]
+
+
 def dispatch(activity: dict):
     from bdc_scripts.radcor.sentinel import tasks as sentinel_tasks
     from bdc_scripts.radcor.landsat import tasks as landsat_tasks
@@ -30,6 +30,8 @@ from osgeo import ogr
 from osgeo.gdalconst import *
 import zipfile
 import utils
+# Cloud mask decoders shared with bdc_scripts (bdc_scripts/core/mask.py copied to /ds_include/bdc_mask.py)
+from bdc_mask import decode_mask, mask_counts
 from  utils import c2jyd,do_insert,do_update,do_upsert,do_query,do_command,decodePeriods,decodePathRow
 import shutil
 from flask_cors import CORS
@@ -120,105 +122,15 @@ def getMask(filename,dataset):
 # Get the image
 	raster = mdataset.GetRasterBand(1).ReadAsArray(0, 0, mdataset.RasterXSize, mdataset.RasterYSize) 
 
-# Output Cloud Mask codes
-# 0 - fill
-# 1 - clear data
-# 0 - cloud
-
-	if dataset == 'LC8SR':
-
-# Input pixel_qa codes
-		fill    = 1 				# warped images have 0 as fill area
-		terrain = 2					# 0000 0000 0000 0010
-		radsat  = 4+8				# 0000 0000 0000 1100
-		cloud   = 16+32+64			# 0000 0000 0110 0000
-		shadow  = 128+256			# 0000 0001 1000 0000
-		snowice = 512+1024			# 0000 0110 0000 0000
-		cirrus  = 2048+4096			# 0001 1000 0000 0000
-
-		unique, counts = numpy.unique(raster, return_counts=True)
-		for i in range(0,unique.shape[0]):
-			app.logger.warning('getMask  -  Level {0}  \t{0:#018b} counts {1} '.format(unique[i],counts[i]))
-			if unique[i] & terrain != 0:
-				app.logger.warning('\t -  terrain {0:9d} \t{0:#018b}- {1}'.format(unique[i] & terrain,'2'))
-			if unique[i] & radsat  != 0: 
-				app.logger.warning('\t -  radsat  {0:9d} \t{0:#018b}- {1}'.format(unique[i] & radsat,'4+8'))
-			if unique[i] & cloud   != 0: 
-				app.logger.warning('\t -  cloud   {0:9d} \t{0:#018b}- {1}'.format(unique[i] & cloud,'16+32+64'))
-			if unique[i] & shadow  != 0: 
-				app.logger.warning('\t -  shadow  {0:9d} \t{0:#018b}- {1}'.format(unique[i] & shadow,'128+256'))
-			if unique[i] & snowice != 0: 
-				app.logger.warning('\t -  snowice {0:9d} \t{0:#018b}- {1}'.format(unique[i] & snowice,'512+1024'))
-			if unique[i] & cirrus != 0:  
-				app.logger.warning('\t -  cirrus  {0:9d} \t{0:#018b}- {1}'.format(unique[i] & cirrus,'2048+4096'))
-			if unique[i] & fill != 0: 
-				app.logger.warning('\t -  fill {0:9d} \t{0:#018b}- {1}'.format(unique[i] & fill,'1'))
-
-# Start with a zeroed image imagearea
-		imagearea = numpy.zeros(raster.shape, dtype=numpy.bool_)
-# Mark with True the pixels that contain valid data
-		imagearea = imagearea + raster > fill
-# Create a notcleararea mask with True where the quality criteria is as follows
-		notcleararea = 	(raster & radsat > 4) + \
-					(raster & cloud > 64) + \
-					(raster & shadow > 256) + \
-					(raster & snowice > 512) + \
-					(raster & cirrus > 4096) 
-
-		strel = morphology.selem.square(6)
-		notcleararea = morphology.binary_dilation(notcleararea,strel)
-		morphology.remove_small_holes(notcleararea, area_threshold=80, connectivity=1, in_place=True)
-
-	# Clear area is the area with valid data and with no Cloud or Snow
-		cleararea = imagearea * numpy.invert(notcleararea)
-	# Code the output image rastercm as the output codes
-		rastercm = (2*notcleararea + cleararea).astype(numpy.uint16)
-
-
-	elif dataset == 'MOD13Q1' or dataset == 'MYD13Q1':
-#MOD13Q1 Pixel Reliability !!!!!!!!!!!!!!!!!!!! Note that 1 was added to this image in downloadModis because of warping
-# Rank/Key Summary QA 		Description
-# -1 		Fill/No Data 	Not Processed
-# 0 		Good Data 		Use with confidence
-# 1 		Marginal data 	Useful, but look at other QA information
-# 2 		Snow/Ice 		Target covered with snow/ice
-# 3 		Cloudy 			Target not visible, covered with cloud
-		fill    = 0 	# warped images have 0 as fill area
-		lut = numpy.array([0,1,1,2,2],dtype=numpy.uint8)
-		rastercm = numpy.take(lut,raster).astype(numpy.uint16)
-
-	elif dataset == 'S2SR':
-# S2 sen2cor - The generated classification map is specified as follows:
-# Label Classification
-# 0		NO_DATA
-# 1		SATURATED_OR_DEFECTIVE
-# 2		DARK_AREA_PIXELS
-# 3		CLOUD_SHADOWS
-# 4		VEGETATION
-# 5		NOT_VEGETATED
-# 6		WATER
-# 7		UNCLASSIFIED
-# 8		CLOUD_MEDIUM_PROBABILITY
-# 9		CLOUD_HIGH_PROBABILITY
-#10		THIN_CIRRUS
-#11		SNOW               0 1 2 3 4 5 6 7 8 9 10 11
-		lut = numpy.array([0,0,2,2,1,1,1,2,2,2,1, 1],dtype=numpy.uint16)
-		rastercm = numpy.take(lut,raster).astype(numpy.uint16)
-
-	elif dataset == 'CB4_AWFI' or dataset == 'CB4_MUX':
-# Key 		Summary QA 		Description
-# 0 		Fill/No Data 	Not Processed
-# 127 		Good Data 		Use with confidence
-# 255 		Cloudy 			Target not visible, covered with cloud
-		fill = 0 		# warped images have 0 as fill area
-		lut = numpy.zeros(256,dtype=numpy.uint8)
-		lut[127] = 1
-		lut[255] = 2
-		rastercm = numpy.take(lut,raster).astype(numpy.uint16)
-
-	unique, counts = numpy.unique(rastercm, return_counts=True)
-	for i in range(0,unique.shape[0]):
-		app.logger.warning('getMask -  i {} unique {} counts {}'.format(i,unique[i],counts[i]))
+# Decode the cloud mask codes (0 - fill, 1 - clear data, 2 - cloud) with the decoders of bdc_scripts
+	if dataset == 'MOD13Q1' or dataset == 'MYD13Q1':
+# Note that 1 was added to this image in downloadModis because of warping, so fill (0) goes back to -1
+		raster = raster.astype(numpy.int32) - 1
+	rastercm = decode_mask(raster,dataset).astype(numpy.uint16)
+
+	counts = mask_counts(rastercm)
+	for i in range(0,counts.shape[0]):
+		app.logger.warning('getMask -  i {} unique {} counts {}'.format(i,i,counts[i]))
 
 	cmdataset = driver.Create( masked, mdataset.RasterXSize, mdataset.RasterYSize, 1, gdal. GDT_UInt16,  options = [ 'COMPRESS=LZW','TILED=YES' ] )
 	# Set the geo-transform to the dataset
@@ -230,9 +142,6 @@ def getMask(filename,dataset):
 	cmdataset.GetRasterBand(1).WriteArray( rastercm )
 	cmdataset = None
 	raster = None
-	notcleararea = None
-	cleararea = None
-	imagearea = None
 	return rastercm
 
 
@@ -339,9 +248,8 @@ def openSearchINPE(activity):
 ################################
 def getMaskStats(mask):
 	totpix   = mask.size
-	fillpix  = numpy.count_nonzero(mask==0)
-	clearpix = numpy.count_nonzero(mask==1)
-	cloudpix = numpy.count_nonzero(mask==2)
+	# Count fill (0), clear (1) and cloud (2) pixels in a single pass
+	fillpix, clearpix, cloudpix = [int(count) for count in mask_counts(mask)]
 	imagearea = clearpix+cloudpix
 	clearratio = 0
 	cloudratio = 100
@@ -4,7 +4,10 @@ import os
 from setuptools import find_packages, setup
 
 
-tests_require = []
+tests_require = [
+    'pytest>=5.2.0',
+    'fakeredis[lua]>=1.1.0',
+]
 
 
 extras_require = {
@@ -0,0 +1,26 @@
+"""
+Defines the shared fixtures of bdc_scripts tests.
+
+The shared Redis client is replaced by fakeredis before any module
+imports it, so tests do not need a Redis server.
+"""
+
+# 3rdparty
+import fakeredis
+import pytest
+
+# BDC Scripts
+from bdc_scripts.celery import cache
+
+
+cache.client = fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def redis_client():
+    """Empty fake Redis."""
+    fake = fakeredis.FakeRedis()
+
+    yield fake
+
+    fake.flushall()
@@ -0,0 +1,103 @@
+"""Unit tests of datastorm merge of quality bands, block by block."""
+
+# 3rdparty
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+import numpy
+import pytest
+import rasterio
+
+# BDC Scripts
+from bdc_scripts.core import mask
+from bdc_scripts.datastorm import utils, warp
+
+
+# LC8SR pixel_qa values
+CLEAR = 322
+CLOUD = 480
+
+SIZE = 192
+
+BLOCK_SIZE = 64
+
+SRS = 'EPSG:32723'
+
+TRANSFORM = from_origin(500000, 8000000, 30, 30)
+
+
+@pytest.fixture
+def quality_file(tmp_path):
+    """LC8SR pixel_qa with a clear corridor which enters the first column of blocks by a few pixels."""
+    pixel_qa = numpy.full((SIZE, SIZE), CLOUD, dtype=numpy.uint16)
+    pixel_qa[0:40, 0:40] = CLEAR
+    pixel_qa[90:98, BLOCK_SIZE - 6:] = CLEAR
+
+    file = str(tmp_path / 'pixel_qa.tif')
+
+    with rasterio.open(file, 'w', driver='GTiff', width=SIZE, height=SIZE, count=1, dtype='uint16',
+                       crs=SRS, transform=TRANSFORM, nodata=1) as dataset:
+        dataset.write(pixel_qa, 1)
+
+    return file
+
+
+def merge_quality(quality_file, merged_file, block_size):
+    utils._warp_merge(str(merged_file), [dict(link=quality_file)], SIZE, SIZE, TRANSFORM, SRS, 1,
+                      Resampling.nearest, 'quality', 'LC8SR', block_size)
+
+    with rasterio.open(str(merged_file)) as dataset:
+        return dataset.read(1)
+
+
+def test_blocks_decode_quality_as_whole_tile(quality_file, tmp_path):
+    whole = merge_quality(quality_file, tmp_path / 'whole.tif', block_size=0)
+    blocks = merge_quality(quality_file, tmp_path / 'blocks.tif', block_size=BLOCK_SIZE)
+
+    # The corridor is clear in the first block only through the rest of tile
+    assert (whole[90:98, BLOCK_SIZE - 6:BLOCK_SIZE] == 1).any()
+    numpy.testing.assert_array_equal(blocks, whole)
+
+
+def test_halo_covers_hole_removal(quality_file, tmp_path, monkeypatch):
+    # A halo shorter than the hole area takes the corridor end as a small hole
+    monkeypatch.setattr(mask.get_mask_decoder('LC8SR'), 'halo', 16)
+
+    whole = merge_quality(quality_file, tmp_path / 'whole.tif', block_size=0)
+    blocks = merge_quality(quality_file, tmp_path / 'blocks.tif', block_size=BLOCK_SIZE)
+
+    assert (blocks != whole).any()
+
+
+def write_band(file, value):
+    with rasterio.open(str(file), 'w', driver='GTiff', width=SIZE, height=SIZE, count=1, dtype='int16',
+                       crs=SRS, transform=from_origin(500015, 7999985, 30, 30), nodata=-9999) as dataset:
+        dataset.write(numpy.arange(SIZE * SIZE, dtype=numpy.int16).reshape(SIZE, SIZE) + value, 1)
+
+    return dict(link=str(file), sceneid='LC08_221069_20190101')
+
+
+def test_bands_of_scene_share_warp(tmp_path, monkeypatch):
+    band_assets = [[write_band(tmp_path / '{}.tif'.format(band), value)] for band, value in (('red', 0), ('nir', 7))]
+
+    def merge_band(assets, name, scene_warps=None):
+        utils._warp_merge(str(tmp_path / name), assets, SIZE, SIZE, TRANSFORM, SRS, None, Resampling.bilinear,
+                          'red', 'LC8SR', BLOCK_SIZE, scene_warps=scene_warps)
+
+        with rasterio.open(str(tmp_path / name)) as dataset:
+            return dataset.read(1)
+
+    expected = [merge_band(assets, 'expected-{}.tif'.format(index)) for index, assets in enumerate(band_assets)]
+
+    warped_vrts = []
+    monkeypatch.setattr(warp, 'WarpedVRT', lambda *args, **kwargs: warped_vrts.append(1) or WarpedVRT(*args, **kwargs))
+
+    with warp.SceneWarps(band_assets) as scene_warps:
+        merged = [merge_band(assets, 'merged-{}.tif'.format(index), scene_warps=scene_warps)
+                  for index, assets in enumerate(band_assets)]
+
+    assert len(warped_vrts) == 1
+
+    for merged_band, expected_band in zip(merged, expected):
+        assert (merged_band != -9999).any()
+        numpy.testing.assert_array_equal(merged_band, expected_band)
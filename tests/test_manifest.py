@@ -0,0 +1,41 @@
+"""Unit tests of the manifest of published files."""
+
+# Python Native
+import os
+
+# BDC Scripts
+from bdc_scripts.config import Config
+from bdc_scripts.radcor.manifest import ProductManifest, checksum
+
+
+def write(file, content):
+    with open(str(file), 'wb') as f:
+        f.write(content)
+
+    return str(file)
+
+
+def test_checksum_recorded_once_and_verified_on_demand(tmp_path, monkeypatch):
+    file = write(tmp_path / 'scene_NDVI.tif', b'published')
+    source = write(tmp_path / 'scene_B04.jp2', b'source')
+
+    manifest = ProductManifest(str(tmp_path))
+    entry = manifest.record(file, sources=[source], cog=True)
+    manifest.save()
+
+    assert entry['checksum'] == checksum(file)
+
+    # Corrupt the file keeping its size and modification time
+    stat = os.stat(file)
+    write(file, b'corrupt!!')
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    manifest = ProductManifest(str(tmp_path))
+
+    assert manifest.is_up_to_date(file, sources=[source])
+    assert not manifest.is_up_to_date(file, sources=[source], verify=True)
+
+    monkeypatch.setattr(Config, 'PUBLISH_VERIFY_CHECKSUM', True)
+
+    assert not manifest.is_up_to_date(file, sources=[source])
+    assert not manifest.is_complete()
@@ -0,0 +1,50 @@
+"""Unit tests of the cloud mask registry helpers."""
+
+# Python Native
+import os
+
+# 3rdparty
+from rasterio.transform import from_origin
+import numpy
+import rasterio
+
+# BDC Scripts
+from bdc_scripts.core import mask
+from bdc_scripts.radcor.sentinel.publish import compute_cloud_cover
+
+
+def write_scl(file, values):
+    with rasterio.open(str(file), 'w', driver='GTiff', width=values.shape[1], height=values.shape[0], count=1,
+                       dtype='uint8', crs='EPSG:32723', transform=from_origin(500000, 8000000, 20, 20)) as dataset:
+        dataset.write(values, 1)
+
+    return str(file)
+
+
+def test_batch_mask_counts():
+    masks = numpy.array([[[0, 1], [1, 2]], [[2, 2], [2, 2]], [[1, 1], [1, 0]]], dtype=numpy.uint8)
+
+    counts = mask.batch_mask_counts(masks)
+
+    numpy.testing.assert_array_equal(counts, [mask.mask_counts(m) for m in masks])
+
+
+def test_load_mask_reuses_mask_of_same_decoder(tmp_path, monkeypatch):
+    # 0 nodata, 4 vegetation, 8 cloud medium probability, 10 thin cirrus
+    scl = write_scl(tmp_path / 'T23LLF_20190101T132231_SCL.tif', numpy.array([[0, 4], [8, 10]], dtype=numpy.uint8))
+
+    assert compute_cloud_cover(scl) == 67
+
+    mask_file = str(tmp_path / 'T23LLF_20190101T132231_SCL_mask.tif')
+    assert os.path.exists(mask_file)
+
+    decoded = []
+    decode = mask.MaskDecoder.decode
+    monkeypatch.setattr(mask.MaskDecoder, 'decode', lambda self, raster: decoded.append(self.name) or decode(self, raster))
+
+    assert compute_cloud_cover(scl) == 67
+    assert decoded == []
+
+    # Catalog cloud cover takes thin cirrus as cloud, while S2SR takes it as clear
+    numpy.testing.assert_array_equal(mask.load_mask(scl, 'S2SR'), [[0, 1], [2, 1]])
+    assert decoded == ['sentinel_scene_classification']
@@ -0,0 +1,107 @@
+"""Unit tests of catalog replication, using an in memory outbox and remote catalog."""
+
+# Python Native
+from types import SimpleNamespace
+from unittest import mock
+
+# 3rdparty
+from sqlalchemy.exc import IntegrityError, OperationalError
+import pytest
+
+# BDC Scripts
+from bdc_scripts.config import Config
+from bdc_scripts.radcor import replication
+
+
+class Remote:
+    """Remote catalog which may be down or reject some collection items."""
+    def __init__(self):
+        self.down = False
+        self.rejected = set()
+        self.items = []
+        self.commits = 0
+        self.writes = 0
+
+    def write(self, items):
+        self.writes += 1
+
+        if self.down:
+            raise OperationalError('INSERT', {}, ConnectionRefusedError('could not connect to server'))
+
+        for data in items:
+            if data['id'] in self.rejected:
+                raise IntegrityError('INSERT', {}, ValueError('invalid item {}'.format(data['id'])))
+
+        self.pending = list(items)
+
+    def commit(self):
+        self.items.extend(self.pending)
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = []
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    records = [
+        SimpleNamespace(id=index, model='CollectionItem', data=dict(id='item-{}'.format(index)),
+                        attempts=0, error=None, replicated=None)
+        for index in range(8)
+    ]
+
+    def pending(batch_size):
+        return [record for record in records
+                if record.replicated is None and record.attempts < Config.REPLICATION_MAX_ATTEMPTS][:batch_size]
+
+    remote = Remote()
+
+    monkeypatch.setattr(replication, 'pending', pending)
+    monkeypatch.setattr(replication, 'db', mock.MagicMock())
+    monkeypatch.setattr(replication, 'db_aws', SimpleNamespace(
+        session=SimpleNamespace(commit=remote.commit, rollback=remote.rollback)))
+    monkeypatch.setattr(replication, '_replicate_collection_items', remote.write)
+    monkeypatch.setattr(replication, '_replicate_assets', lambda assets: None)
+
+    return records, remote
+
+
+def test_remote_outage_keeps_outbox(outbox):
+    records, remote = outbox
+    remote.down = True
+
+    for _ in range(Config.REPLICATION_MAX_ATTEMPTS + 2):
+        with pytest.raises(OperationalError):
+            replication.replicate(batch_size=8)
+
+    # One probe per sweep, without bisecting the batch
+    assert remote.writes == Config.REPLICATION_MAX_ATTEMPTS + 2
+    assert all(record.attempts == 0 for record in records)
+    assert remote.commits == 0
+
+    remote.down = False
+
+    assert replication.replicate(batch_size=8) == 8
+    assert len(remote.items) == 8
+    assert remote.commits == 1
+
+
+def test_only_rejected_records_count_attempts(outbox):
+    records, remote = outbox
+    remote.rejected = {'item-3'}
+
+    assert replication.replicate(batch_size=8) == 7
+
+    assert [record.attempts for record in records] == [0, 0, 0, 1, 0, 0, 0, 0]
+    assert records[3].replicated is None and 'item-3' in records[3].error
+    assert all(record.replicated for record in records if record.id != 3)
+
+
+def test_rejected_batch_does_not_count_attempts(outbox):
+    records, remote = outbox
+    remote.rejected = {record.data['id'] for record in records}
+
+    with pytest.raises(IntegrityError):
+        replication.replicate(batch_size=8)
+
+    assert all(record.attempts == 0 for record in records)
@@ -0,0 +1,195 @@
+"""Unit tests of the SciHub accounts pool."""
+
+# Python Native
+import os
+import socket
+
+# 3rdparty
+import pytest
+
+# BDC Scripts
+from bdc_scripts.config import Config
+from bdc_scripts.radcor.sentinel import clients
+from bdc_scripts.radcor.sentinel.clients import UserClients
+
+
+USERS = {
+    'alice': {'password': 'alice-pwd', 'count': 0},
+    'bob': {'password': 'bob-pwd', 'count': 0}
+}
+
+
+@pytest.fixture
+def pool(redis_client):
+    return UserClients(users=USERS, redis_client=redis_client)
+
+
+def _take_all(pool):
+    users = []
+
+    while True:
+        user = pool.use()
+
+        if user is None:
+            return users
+
+        users.append(user)
+
+
+def test_use_gives_slots_per_account(pool):
+    users = _take_all(pool)
+
+    assert sorted(user.username for user in users) == ['alice', 'alice', 'bob', 'bob']
+    assert {user.username: user.password for user in users} == {'alice': 'alice-pwd', 'bob': 'bob-pwd'}
+    assert pool.users['alice']['count'] == Config.SENTINEL_SLOTS_PER_ACCOUNT
+
+    for user in users:
+        user.release()
+
+
+def test_done_returns_slot_to_pool(pool):
+    users = _take_all(pool)
+
+    users[0].release()
+
+    user = pool.use()
+
+    assert user is not None
+    assert user.username == users[0].username
+    assert pool.use() is None
+
+    for user in users[1:] + [user]:
+        user.release()
+
+
+def test_double_release_does_not_create_slots(pool):
+    with pool.use() as user:
+        pass
+
+    user.release()
+    pool.done(user.username, user.lease)
+
+    assert len(_take_all(pool)) == 2 * Config.SENTINEL_SLOTS_PER_ACCOUNT
+
+
+def _move_slot(pool, redis_client, worker):
+    """Take a slot and move it to another worker, as if that worker had taken it."""
+    user = pool.use()
+
+    redis_client.rename(pool._in_use_key(), pool._in_use_key(worker))
+    redis_client.sadd(pool._workers_key, pool._in_use_key(worker))
+
+    return user
+
+
+def test_recover_only_dead_workers(pool, redis_client, monkeypatch):
+    hostname = socket.gethostname()
+    dead, alive = '{}:1000001'.format(hostname), '{}:1000002'.format(hostname)
+
+    monkeypatch.setattr(clients, '_is_running', lambda pid: pid == 1000002)
+
+    dead_user = _move_slot(pool, redis_client, dead)
+    alive_user = _move_slot(pool, redis_client, alive)
+
+    assert pool.recover() == 1
+    assert redis_client.llen(pool._in_use_key(alive)) == 1
+    assert not redis_client.exists(pool._in_use_key(dead))
+    assert len(_take_all(pool)) == 2 * Config.SENTINEL_SLOTS_PER_ACCOUNT - 1
+
+    # Instances were moved to other workers
+    dead_user._released = alive_user._released = True
+
+
+def test_recover_ignores_other_hosts(pool, redis_client, monkeypatch):
+    monkeypatch.setattr(clients, '_is_running', lambda pid: False)
+
+    user = _move_slot(pool, redis_client, 'another-host:1000001')
+
+    assert pool.recover() == 0
+
+    user._released = True
+
+
+def test_register_reconciles_slots(pool, redis_client, monkeypatch):
+    monkeypatch.setattr(Config, 'SENTINEL_SLOTS_PER_ACCOUNT', 3)
+
+    pool = UserClients(users=USERS, redis_client=redis_client)
+
+    users = _take_all(pool)
+
+    assert sorted(user.username for user in users) == ['alice'] * 3 + ['bob'] * 3
+
+    for user in users:
+        user.release()
+
+
+def test_register_counts_slots_taken_concurrently(pool, redis_client, monkeypatch):
+    # Slot taken by a worker which just started, while another worker registers the accounts:
+    # its list of slots in use is created after any SCAN of the registering worker
+    user = _move_slot(pool, redis_client, 'another-host:1000001')
+
+    monkeypatch.setattr(redis_client, 'scan_iter', lambda *args, **kwargs: iter([]))
+
+    UserClients(users=USERS, redis_client=redis_client)
+
+    assert redis_client.llen(pool._tokens_key) == 2 * Config.SENTINEL_SLOTS_PER_ACCOUNT - 1
+
+    user._released = True
+
+
+def test_register_drops_removed_accounts(pool, redis_client):
+    in_use = _take_all(pool)
+
+    # bob is removed while its slots are in use
+    pool = UserClients(users={'alice': USERS['alice']}, redis_client=redis_client)
+
+    assert 'bob' not in pool.users
+
+    for user in in_use:
+        user._pool = pool
+        user.release()
+
+    users = _take_all(pool)
+
+    assert sorted(user.username for user in users) == ['alice'] * Config.SENTINEL_SLOTS_PER_ACCOUNT
+
+    for user in users:
+        user.release()
+
+
+def test_reap_reclaims_expired_leases(pool, redis_client):
+    user = pool.use()
+
+    # Lease expired for Redis clock
+    redis_client.zadd(pool._leases_key, {user.lease: pool.now() - 1})
+
+    assert pool.reap() == 1
+    assert not pool.refresh(user.lease)
+    assert len(_take_all(pool)) == 2 * Config.SENTINEL_SLOTS_PER_ACCOUNT
+
+    user._released = True
+
+
+def test_leases_use_redis_clock(pool, redis_client):
+    user = pool.use()
+
+    expiration = redis_client.zscore(pool._leases_key, user.lease)
+
+    assert abs(expiration - (pool.now() + Config.SENTINEL_LEASE_TTL)) < 5
+
+    user.release()
+
+
+def test_heartbeat_signals_lost_lease(pool, redis_client, monkeypatch):
+    monkeypatch.setattr(Config, 'SENTINEL_LEASE_TTL', 1)
+
+    user = pool.use()
+
+    redis_client.zrem(pool._leases_key, user.lease)
+
+    assert user.lost.wait(5)
+
+    with pytest.raises(clients.LeaseLostError):
+        user.check()
+
+    user._released = True
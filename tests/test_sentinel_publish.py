@@ -0,0 +1,87 @@
+"""Unit tests of Sentinel publish from extracted SAFE products."""
+
+# Python Native
+from types import SimpleNamespace
+from unittest import mock
+from zipfile import ZipFile
+import os
+
+# BDC Scripts
+from bdc_scripts.config import Config
+from bdc_scripts.core.utils import extractall
+from bdc_scripts.radcor import manifest
+from bdc_scripts.radcor.sentinel import publish
+from bdc_scripts.radcor.sentinel.safe import SEN2COR_BANDS, safe_members, safe_root
+
+
+L1C_SAFE = 'S2A_MSIL1C_20190101T132231_N0207_R038_T23LLF_20190101T145128.SAFE'
+
+L1C_GRANULE = '{}/GRANULE/L1C_T23LLF_A018432_20190101T132231'.format(L1C_SAFE)
+
+
+def make_l1c_zip(directory):
+    """Write a L1C SAFE zip with empty images."""
+    names = ['{}/MTD_MSIL1C.xml'.format(L1C_SAFE),
+             '{}/HTML/banner.png'.format(L1C_SAFE),
+             '{}/QI_DATA/T23LLF_20190101T132231_PVI.jp2'.format(L1C_GRANULE),
+             '{}/IMG_DATA/T23LLF_20190101T132231_TCI.jp2'.format(L1C_GRANULE)]
+    names += ['{}/IMG_DATA/T23LLF_20190101T132231_{}.jp2'.format(L1C_GRANULE, band) for band in SEN2COR_BANDS]
+
+    file = os.path.join(str(directory), '{}.zip'.format(L1C_SAFE[:-len('.SAFE')]))
+
+    with ZipFile(file, 'w') as archive:
+        for name in names:
+            archive.writestr(name, name)
+
+    return file, names
+
+
+def fake_generate_cogs_parallel(conversions):
+    for conversion in conversions:
+        with open(conversion['file_path'], 'w') as f:
+            f.write(conversion['input_data_set_path'])
+
+        yield conversion, dict(file=conversion['file_path'], raster_size_x=10980, raster_size_y=10980,
+                               chunk_size_x=256, chunk_size_y=256)
+
+
+def fake_generate_evi_ndvi(red, nir, blue, evi_name, ndvi_name):
+    for file in (evi_name, ndvi_name):
+        with open(file, 'w') as f:
+            f.write(file)
+
+
+def test_extract_and_publish_l1c(tmp_path, monkeypatch):
+    zip_file, names = make_l1c_zip(tmp_path)
+
+    extracted = extractall(zip_file, members=safe_members(names))
+
+    assert '{}/IMG_DATA/T23LLF_20190101T132231_TCI.jp2'.format(L1C_GRANULE) in extracted
+    assert not any(name.endswith('_PVI.jp2') or '/HTML/' in name for name in extracted)
+
+    quick_looks = []
+    db = mock.MagicMock()
+    db.session.query.return_value.filter.return_value.all.return_value = [
+        SimpleNamespace(id=index, name=name) for index, name in enumerate(list(publish.BAND_MAP) + ['NDVI', 'EVI'])
+    ]
+
+    monkeypatch.setattr(Config, 'DATA_DIR', str(tmp_path / 'data'))
+    monkeypatch.setattr(publish, 'db', db)
+    monkeypatch.setattr(publish, 'generate_cogs_parallel', fake_generate_cogs_parallel)
+    monkeypatch.setattr(publish, 'generate_evi_ndvi', fake_generate_evi_ndvi)
+    monkeypatch.setattr(publish, 'create_qlook_file', lambda pngname, qlfile: quick_looks.append(qlfile))
+    monkeypatch.setattr(publish, 'bulk_get_or_create',
+                        lambda model, rows, keys, engine: [SimpleNamespace(url=row['url']) for row in rows])
+    monkeypatch.setattr(publish, 'add_instance', lambda *args: None)
+    monkeypatch.setattr(publish, 'commit', lambda engine: None)
+    monkeypatch.setattr(manifest, 'is_cog', lambda file: True)
+
+    collection_item = SimpleNamespace(id='S2A_MSIL1C_20190101T132231', collection_id='S2TOA', tile_id='23LLF')
+    scene = SimpleNamespace(id=1, collection_id='S2TOA', sceneid=L1C_SAFE[:-len('.SAFE')],
+                            args=dict(file=os.path.join(str(tmp_path), safe_root(names))),
+                            collection=SimpleNamespace(grs_schema_id='MGRS'))
+
+    assets = publish.publish(collection_item, scene)
+
+    assert [os.path.basename(file) for file in quick_looks] == ['T23LLF_20190101T132231_TCI.jp2']
+    assert set(assets) == set(SEN2COR_BANDS) | {'NDVI', 'EVI', 'quicklook'}